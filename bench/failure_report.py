@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Benchmark reporting a failure early in a huge output.
+
+Times matching the output up to the failure, plus building the failure
+message, with the default -A and -B. With --against, another
+littlecheck.py (e.g. an older checkout) is timed the same way.
+"""
+
+import argparse
+
+import synth
+from util import best_of, load_module
+
+import littlecheck
+
+
+def make_testrun(module):
+    """Return a TestRun whose checks fail on the third line of output."""
+    text = (
+        "# RUN: true\n"
+        "# CHECK: output line 0 {{x*}}\n"
+        "# CHECK: output line 1 {{x*}}\n"
+        "# CHECK: something else\n"
+    )
+    checker = module.Checker(
+        "synth", module.Line.readfile(text.splitlines(True), "synth")
+    )
+    runcmd = checker.runcmds[0]
+    return module.TestRun("synth", runcmd, checker, {}, module.Config())
+
+
+def report(module, testrun, data):
+    if hasattr(module, "OutputBuffer"):
+        output = module.OutputBuffer(data)
+        failure = testrun.check_output(output, testrun.checker.outchecks, "stdout")
+    else:
+        lines = [
+            module.Line(text + "\n", idx + 1, "stdout")
+            for idx, text in enumerate(data.decode("utf-8").split("\n"))
+        ]
+        failure = testrun.check(lines, testrun.checker.outchecks)
+    return failure.message()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lines", type=int, action="append", default=[])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--against", help="Another littlecheck.py to compare with")
+    args = parser.parse_args()
+    sizes = args.lines or [10000, 100000, 1000000]
+
+    modules = [("current", littlecheck)]
+    if args.against:
+        modules.insert(0, ("--against", load_module(args.against)))
+    print("{:>8} {:>10}  {:<12} {:>10}".format("lines", "bytes", "module", "seconds"))
+    for size in sizes:
+        data = synth.large_output(size)
+        for label, module in modules:
+            testrun = make_testrun(module)
+            seconds = best_of(lambda: report(module, testrun, data), args.repeat)
+            print(
+                "{:>8} {:>10}  {:<12} {:>10.4f}".format(size, len(data), label, seconds)
+            )
+
+
+if __name__ == "__main__":
+    main()
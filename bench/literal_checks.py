@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Benchmark files whose checks are mostly plain literals.
+
+Times parsing the file into a Checker and matching the output against its
+checks, where 90% of the checks have no {{...}} and the rest start with a
+literal prefix. With --against, another littlecheck.py (e.g. an older
+checkout) is timed the same way.
+"""
+
+import argparse
+import io
+
+from util import best_of, load_module
+
+import littlecheck
+
+
+def literal_file(lines):
+    """Return the text of a test file and its matching output."""
+    checks = []
+    out = []
+    for i in range(lines):
+        out.append("result {} is ready after {} steps\n".format(i, i % 97))
+        if i % 10:
+            checks.append(
+                "# CHECK: result {} is ready after {} steps\n".format(i, i % 97)
+            )
+        else:
+            checks.append(
+                "# CHECK: result {} is ready after {{{{\\d+}}}} steps\n".format(i)
+            )
+    return "# RUN: true\n" + "".join(checks), "".join(out)
+
+
+def parse(module, text):
+    if hasattr(module.Checker, "from_text"):
+        return module.Checker.from_text("synth", text)
+    return module.Checker("synth", module.Line.readfile(io.StringIO(text), "synth"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lines", type=int, action="append", default=[])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--against", help="Another littlecheck.py to compare with")
+    args = parser.parse_args()
+    sizes = args.lines or [1000, 10000, 100000]
+
+    modules = [("current", littlecheck)]
+    if args.against:
+        modules.insert(0, ("--against", load_module(args.against)))
+    print("{:>8}  {:<12} {:>10} {:>10}".format("lines", "module", "parse", "match"))
+    for size in sizes:
+        text, output = literal_file(size)
+        for label, module in modules:
+            checker = parse(module, text)
+            testrun = module.TestRun(
+                "synth", checker.runcmds[0], checker, {}, module.Config()
+            )
+            lines = [
+                module.Line(line, idx + 1, "stdout")
+                for idx, line in enumerate(output.splitlines(True))
+            ]
+            assert testrun.check(lines, checker.outchecks) is None
+            parse_seconds = best_of(lambda: parse(module, text), args.repeat)
+            match_seconds = best_of(
+                lambda: testrun.check(lines, checker.outchecks), args.repeat
+            )
+            print(
+                "{:>8}  {:<12} {:>10.4f} {:>10.4f}".format(
+                    size, label, parse_seconds, match_seconds
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Benchmark the memory and time used to check large command output.
+
+Compares a Line object per output line (as before OutputBuffer) with
+TestRun.check_output on an OutputBuffer. With --against, another
+littlecheck.py (e.g. an older checkout) is measured the same way.
+The last line of output fails to match, so all lines before it are matched.
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+
+import synth
+from util import best_of, load_module
+
+import littlecheck
+
+
+def make_testrun(module, lines):
+    """Return a TestRun whose checks match all but one of lines of output."""
+    text = "# RUN: true\n# CHECK: output line {{\\d+}} {{x*}}\n"
+    lcs = module.Line.readfile(text.splitlines(True), "synth")
+    checker = module.Checker("synth", lcs)
+    checker.outchecks = checker.outchecks * lines
+    checker.outchecks[-1] = module.CheckCmd.parse(
+        module.Line("something else", 2, "synth"), "CHECK"
+    )
+    config = module.Config()
+    runcmd = checker.runcmds[0]
+    return module.TestRun("synth", runcmd, checker, {}, config)
+
+
+def with_lines(module, testrun, data):
+    lines = [
+        module.Line(text + "\n", idx + 1, "stdout")
+        for idx, text in enumerate(data.decode("utf-8").split("\n"))
+    ]
+    return testrun.check(lines, testrun.checker.outchecks)
+
+
+def with_buffer(module, testrun, data):
+    output = module.OutputBuffer(data)
+    return testrun.check_output(output, testrun.checker.outchecks, "stdout")
+
+
+def measure(func, *args):
+    """Return the peak traced memory in bytes, and the untraced time in seconds."""
+    gc.collect()
+    start = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lines", type=int, action="append", default=[])
+    parser.add_argument("--against", help="Another littlecheck.py to compare with")
+    args = parser.parse_args()
+    sizes = args.lines or [100000, 1000000]
+
+    modules = [("current", littlecheck)]
+    if args.against:
+        modules.insert(0, ("--against", load_module(args.against)))
+    print(
+        "{:>8} {:>10}  {:<24} {:>12} {:>10}".format(
+            "lines", "bytes", "method", "peak MiB", "seconds"
+        )
+    )
+    for size in sizes:
+        data = synth.large_output(size)
+        for label, module in modules:
+            methods = [("Line per line", with_lines)]
+            if hasattr(module, "OutputBuffer"):
+                methods.append(("OutputBuffer", with_buffer))
+            testrun = make_testrun(module, size)
+            for name, func in methods:
+                peak, seconds = measure(func, module, testrun, data)
+                print(
+                    "{:>8} {:>10}  {:<24} {:>12.1f} {:>10.3f}".format(
+                        size, len(data), label + ": " + name, peak / 2**20, seconds
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Benchmark parsing large test files into Checkers.
+
+Compares building a Checker from a Line per input line with the
+single-pass Checker.from_text scanner. With --against, the same files are
+parsed by another littlecheck.py (e.g. an older checkout) for comparison.
+"""
+
+import argparse
+import io
+
+import synth
+from util import best_of, load_module
+
+import littlecheck
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lines", type=int, action="append", default=[])
+    parser.add_argument("--directive-every", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--against", help="Another littlecheck.py to compare with")
+    args = parser.parse_args()
+    sizes = args.lines or [10000, 100000, 500000]
+    against = load_module(args.against) if args.against else None
+
+    print(
+        "{:>8} {:>10}  {:<28} {:>10} {:>12}".format(
+            "lines", "bytes", "method", "seconds", "MB/s"
+        )
+    )
+    for size in sizes:
+        text = synth.large_file(size, args.directive_every)
+        methods = [
+            (
+                "Line per line",
+                lambda: littlecheck.Checker(
+                    "synth", littlecheck.Line.readfile(io.StringIO(text), "synth")
+                ),
+            ),
+            ("Checker.from_text", lambda: littlecheck.Checker.from_text("synth", text)),
+        ]
+        if against:
+            methods.insert(
+                0,
+                (
+                    "--against",
+                    lambda: against.Checker(
+                        "synth", against.Line.readfile(io.StringIO(text), "synth")
+                    ),
+                ),
+            )
+        for name, func in methods:
+            seconds = best_of(func, args.repeat)
+            print(
+                "{:>8} {:>10}  {:<28} {:>10.4f} {:>12.1f}".format(
+                    size, len(text), name, seconds, len(text) / seconds / 1e6
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Benchmark starting littlecheck to check one passing file.
+
+Times, over --repeat cold starts, a bare interpreter and littlecheck.py
+checking a file whose only RUN line is `true`, and reports the difference
+as littlecheck's own startup cost, along with the modules it imported and
+the time spent importing them (from -X importtime, which is less noisy).
+With --against, another littlecheck.py (e.g. an older checkout) is timed
+the same way. With --max-ms, exit with 1 if the startup cost is higher
+than that.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "littlecheck",
+    "littlecheck.py",
+)
+
+
+def best_start(argv, repeat):
+    """Return the shortest wall time in seconds of running argv."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call(argv, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def imported_modules(argv):
+    """Return the names of the modules argv imports, besides the interpreter's,
+    and the seconds spent importing them.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime"] + argv[1:],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    bare = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "pass"],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    def imports(stderr):
+        """Yield (name, microseconds) for each module, except for the header."""
+        for line in stderr.splitlines():
+            if line.startswith("import time:"):
+                self_us, _, name = line[len("import time:") :].split("|")
+                if self_us.strip().isdigit():
+                    yield name.strip(), int(self_us)
+
+    seen = set(name for name, _ in imports(bare.stderr))
+    new = [(name, us) for name, us in imports(proc.stderr) if name not in seen]
+    return [name for name, _ in new], sum(us for _, us in new) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--against", help="Another littlecheck.py to compare with")
+    parser.add_argument("--max-ms", type=float, help="Fail above this startup cost")
+    args = parser.parse_args()
+
+    scripts = [("current", SCRIPT)]
+    if args.against:
+        scripts.insert(0, ("--against", args.against))
+    slowest = 0
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "ok.test")
+        with open(path, "w") as fd:
+            fd.write("# RUN: true\n")
+        bare = best_start([sys.executable, "-c", "pass"], args.repeat)
+        print(
+            "{:<12} {:>10} {:>8} {:>10}".format(
+                "module", "startup", "imports", "import"
+            )
+        )
+        for label, script in scripts:
+            argv = [sys.executable, script, path]
+            cost = best_start(argv, args.repeat) - bare
+            modules, seconds = imported_modules(argv)
+            print(
+                "{:<12} {:>8.1f}ms {:>8} {:>8.1f}ms".format(
+                    label, cost * 1000, len(modules), seconds * 1000
+                )
+            )
+            slowest = max(slowest, cost)
+            if label == "current":
+                print("  " + " ".join(modules), file=sys.stderr)
+    if args.max_ms is not None and slowest * 1000 > args.max_ms:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
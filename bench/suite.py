@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""Benchmark suite for littlecheck's own hot paths.
+
+Generates synthetic test files (many CHECK lines, regex-heavy checks, very
+long output lines, an early failure in a long output, many RUN lines) and
+times, for each of them:
+
+  parse       building the Checker, with Checker.from_text
+  checkcmd    CheckCmd.parse of every CHECK line
+  check       TestRun.check_output of an OutputBuffer against the checks
+  message     TestFailure.message of a failure in that output
+  check_path  a full check_path run, including the commands
+
+The results are written as JSON (--output), so runs of different commits
+can be compared: --baseline takes an earlier result and reports the
+ratios, exiting with 1 if anything got slower by more than --threshold.
+With --against, another littlecheck.py (e.g. an older checkout) is timed
+instead of this one. Modules older than from_text and check_output are
+timed with the Checker constructor and TestRun.check on a list of Lines.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+
+import synth
+from util import best_of, load_module
+
+import littlecheck
+
+# name: (generator, size at --scale 1)
+CASES = {
+    "many_checks": (synth.many_checks, 20000),
+    "regex_checks": (synth.regex_checks, 5000),
+    "long_output": (synth.long_output, 2000),
+    "early_failure": (synth.early_failure, 100000),
+    "many_runs": (synth.many_runs, 100),
+}
+
+PHASES = ("parse", "checkcmd", "check", "message", "check_path")
+
+
+def output_lines(module, data):
+    """Return the output as Lines, the way TestRun.check takes it."""
+    return [
+        module.Line(text, idx + 1, "stdout")
+        for idx, text in enumerate(data.decode("utf-8").splitlines(True))
+    ]
+
+
+def bench_case(module, directory, name, text, data, repeat):
+    """Write the case to directory, and return a dict of phase: seconds."""
+    output = os.path.join(directory, name + ".out")
+    path = os.path.join(directory, name + ".test")
+    with open(output, "wb") as fd:
+        fd.write(data)
+    text = text.replace("{output}", shlex.quote(output))
+    with io.open(path, "w", encoding="utf-8") as fd:
+        fd.write(text)
+
+    if hasattr(module.Checker, "from_text"):
+
+        def parse():
+            return module.Checker.from_text(path, text)
+
+    else:
+
+        def parse():
+            return module.Checker(path, module.Line.readfile(io.StringIO(text), path))
+
+    checker = parse()
+    checklines = [check.line for check in checker.outchecks]
+    config = module.Config()
+    config.colorize = False
+    testrun = module.TestRun(path, checker.runcmds[0], checker, {}, config)
+    lines = output_lines(module, data)
+    failure = testrun.check(lines, checker.outchecks)
+    if failure is None:
+        # Report a made-up failure on the last line, with a full context.
+        failure = module.TestFailure(
+            lines[-1],
+            checker.outchecks[-1],
+            testrun,
+            before=[line.text for line in lines[-config.before - 1 : -1]],
+            after=[],
+        )
+    if hasattr(module.TestRun, "check_output"):
+
+        def check():
+            output = module.OutputBuffer(data)
+            return testrun.check_output(output, checker.outchecks, "stdout")
+
+    else:
+
+        def check():
+            return testrun.check(lines, checker.outchecks)
+
+    subs = {"%": "%", "s": path}
+
+    def check_path():
+        return module.check_path(path, subs, config, lambda failure: None)
+
+    funcs = {
+        "parse": parse,
+        "checkcmd": lambda: [
+            module.CheckCmd.parse(line, "CHECK") for line in checklines
+        ],
+        "check": check,
+        "message": failure.message,
+        "check_path": check_path,
+    }
+    return {phase: best_of(funcs[phase], repeat) for phase in PHASES}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results, threshold, min_time):
+    """Print the results next to the baseline. Return the number of timings
+    that got slower by more than threshold (a fraction). Timings below
+    min_time seconds are too noisy to count.
+    """
+    regressions = 0
+    print(
+        "{:<14} {:<11} {:>10} {:>10} {:>7}".format(
+            "case", "phase", "before", "after", "ratio"
+        )
+    )
+    for case, phases in sorted(results.items()):
+        for phase, seconds in sorted(phases.items()):
+            before = baseline.get(case, {}).get(phase)
+            if not before:
+                continue
+            ratio = seconds / before
+            flag = ""
+            if ratio > 1 + threshold and seconds >= min_time:
+                regressions += 1
+                flag = "  slower"
+            print(
+                "{:<14} {:<11} {:>10.4f} {:>10.4f} {:>7.2f}{}".format(
+                    case, phase, before, seconds, ratio, flag
+                )
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiply the case sizes"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--case", action="append", choices=sorted(CASES), default=[])
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument(
+        "--baseline", help="JSON results of an earlier run to compare with"
+    )
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--min-time", type=float, default=0.005)
+    parser.add_argument("--against", help="Time another littlecheck.py instead")
+    args = parser.parse_args()
+    module = load_module(args.against) if args.against else littlecheck
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.case or sorted(CASES):
+            generator, size = CASES[name]
+            text, data = generator(max(1, int(size * args.scale)))
+            results[name] = bench_case(module, directory, name, text, data, args.repeat)
+            print(
+                "{:<14} ".format(name)
+                + " ".join("{}={:.4f}".format(p, results[name][p]) for p in PHASES),
+                file=sys.stderr,
+            )
+
+    report = {
+        "commit": None if args.against else git_commit(),
+        "module": os.path.abspath(module.__file__),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    elif not args.baseline:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+        if baseline.get("scale") != args.scale:
+            print(
+                "warning: the baseline was run with a different --scale",
+                file=sys.stderr,
+            )
+        sys.exit(
+            1
+            if compare(baseline["results"], results, args.threshold, args.min_time)
+            else 0
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Generators for synthetic littlecheck test files, used by the benchmarks."""
+
+import random
+
+
+def large_file(lines, directive_every=20, seed=0):
+    """Return the text of a test file with the given number of lines,
+    mostly code, with a CHECK or CHECKERR line every directive_every lines.
+    """
+    rng = random.Random(seed)
+    out = ["# RUN: %s\n"]
+    for i in range(1, lines):
+        if i % directive_every == 0:
+            if rng.random() < 0.8:
+                out.append("# CHECK: line {} value {{{{\\d+}}}}\n".format(i))
+            else:
+                out.append("# CHECKERR: warning {}\n".format(i))
+        elif i % 7 == 0:
+            out.append("    # an ordinary comment about line {}\n".format(i))
+        else:
+            out.append('print("line {} value", {})\n'.format(i, rng.randint(0, 999)))
+    return "".join(out)
+
+
+def large_output(lines, width=60):
+    """Return bytes of command output with the given number of lines."""
+    filler = "x" * max(0, width - 20)
+    return "".join(
+        "output line {} {}\n".format(i, filler) for i in range(lines)
+    ).encode("utf-8")
+
+
+# Cases for the benchmark suite. Each returns the text of a test file, whose
+# RUN lines print the output file given by "{output}", and the bytes of that
+# output.
+
+
+def many_checks(lines):
+    """Many short output lines, each with a literal CHECK."""
+    out = "".join("output line {}\n".format(i) for i in range(lines))
+    checks = "".join("# CHECK: output line {}\n".format(i) for i in range(lines))
+    return "# RUN: cat {output}\n" + checks, out.encode("utf-8")
+
+
+def regex_checks(lines, seed=0):
+    """Output lines matched by CHECKs with several {{...}} regexes each."""
+    rng = random.Random(seed)
+    out = "".join(
+        "id={} time=0.{:03d}s status={} host=h{}\n".format(
+            i, rng.randint(0, 999), rng.choice(["ok", "fail"]), rng.randint(0, 99)
+        )
+        for i in range(lines)
+    )
+    check = "# CHECK: id={{\\d+}} time={{[0-9.]+}}s status={{ok|fail}} host={{\\w+}}\n"
+    return "# RUN: cat {output}\n" + check * lines, out.encode("utf-8")
+
+
+def long_output(lines, width=4000):
+    """Few, very long output lines, matched partly literally and partly by regex."""
+    filler = "y" * width
+    out = "".join("{} {}\n".format(i, filler) for i in range(lines))
+    checks = "".join(
+        "# CHECK: {} {}\n".format(i, filler if i % 2 else "{{y+}}")
+        for i in range(lines)
+    )
+    return "# RUN: cat {output}\n" + checks, out.encode("utf-8")
+
+
+def early_failure(lines, at=10):
+    """A long output whose checks fail at line at."""
+    text, out = many_checks(lines)
+    text = text.replace("output line {}\n".format(at), "something else\n", 1)
+    return text, out
+
+
+def many_runs(runs):
+    """Many RUN lines, each checked against the same short output."""
+    text = "# RUN: cat {output}\n" * runs
+    text += "".join("# CHECK: line {}\n".format(i) for i in range(5))
+    out = "".join("line {}\n".format(i) for i in range(5))
+    return text, out.encode("utf-8")
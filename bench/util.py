@@ -0,0 +1,22 @@
+"""Helpers shared by the benchmarks."""
+
+import importlib.util
+import os
+import sys
+import timeit
+
+# Make the littlecheck package in this checkout importable.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_module(path):
+    """Import the littlecheck.py at path, e.g. from an older checkout."""
+    spec = importlib.util.spec_from_file_location("littlecheck_against", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_of(func, repeat):
+    """Return the shortest time in seconds of repeat calls of func."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
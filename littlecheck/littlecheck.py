@@ -2,26 +2,43 @@
 
 """ Command line test driver. """
 
-from __future__ import unicode_literals
-from __future__ import print_function
-
-import argparse
-from collections import deque
-import datetime
+# Modules that only some options or failures need are imported where they are
+# used, since littlecheck is typically started once per test file.
+from collections import OrderedDict, deque
 import io
+import os
 import re
 import shlex
+import signal
 import subprocess
 import sys
-
-# A regex showing how to run the file.
-RUN_RE = re.compile(r"\s*#\s*RUN:\s+(.*)\n")
-
-# A regex capturing lines that should be checked against stdout.
-CHECK_STDOUT_RE = re.compile(r"\s*#\s*CHECK:\s+(.*)\n")
-
-# A regex capturing lines that should be checked against stderr.
-CHECK_STDERR_RE = re.compile(r"\s*#\s*CHECKERR:\s+(.*)\n")
+import time
+
+# The directives, as the keyword before the colon. These are:
+# RUN: how to run the file.
+# CHECK: a line that should be checked against stdout.
+# CHECKERR: a line that should be checked against stderr.
+# TIMEOUT: the number of seconds each RUN command may take.
+DIRECTIVES = ("RUN", "CHECK", "CHECKERR", "TIMEOUT", "MAXTIME", "MAXCPU", "MAXRSS")
+
+# A regex capturing the directive and its text from a line.
+DIRECTIVE_RE = re.compile(r"\s*#\s*(%s):\s+(.*)\n" % "|".join(DIRECTIVES))
+
+# The same, but matching directive lines anywhere in the text of a whole file.
+# [^\S\n] is whitespace that doesn't cross into the next line.
+DIRECTIVE_SCAN_RE = re.compile(
+    r"^[^\S\n]*#[^\S\n]*(%s):[^\S\n]+(.*)\n" % "|".join(DIRECTIVES), re.MULTILINE
+)
+
+# A regex splitting a CHECK line around its {{...}} regular expressions.
+BRACKET_RE = re.compile(
+    r"""
+        \{\{   # Two open brackets
+        (.*?)  # Nongreedy capture
+        \}\}   # Two close brackets
+    """,
+    re.VERBOSE,
+)
 
 
 class Config(object):
@@ -36,6 +53,42 @@ class Config(object):
         self.after = 5
         # How many before lines to print
         self.before = 5
+        # How many RUN lines of a single file to run concurrently
+        self.run_jobs = 1
+        # Whether to match output while it is produced, and stop the
+        # command at the first failure
+        self.fail_early = False
+        # How many seconds a command may run before it is killed, or None
+        self.timeout = None
+        # Output larger than this many bytes is moved from memory to a file,
+        # or None to keep it in memory
+        self.spill_threshold = 64 * 1024 * 1024
+        # Where to put output files, or None for the default temporary
+        # directory. If set, commands write their output there directly.
+        self.spill_dir = None
+        # A CheckerCache to store parsed files in, or None
+        self.cache = None
+        # An IncrementalState to skip unchanged passing RUN lines, or None
+        self.incremental = None
+        # Whether to record a Profile of each file and RUN line
+        self.profile = False
+        # The directory to read files and run commands in, or None for ours
+        self.cwd = None
+        # The environment of the commands, or None for ours
+        self.env = None
+        # Whether to run commands that need no shell without one
+        self.direct_exec = True
+        # ShellSessions to run the commands in, or None to start each in a
+        # process of its own
+        self.shells = None
+        # A Cancellation that stops everything at too many failures, or None
+        self.cancel = None
+        # How many times to run each command and measure it, after running
+        # it warmup times unmeasured
+        self.repeat = 1
+        self.warmup = 0
+        # Whether to only check the output of the first of those runs
+        self.check_first = False
 
     def colors(self):
         """ Return a dictionary mapping color names to ANSI escapes """
@@ -70,10 +123,9 @@ def output(*args):
     print("".join(args) + "\n")
 
 
-import unicodedata
-
-
 def esc(m):
+    import unicodedata
+
     map = {
         "\n": "\\n",
         "\\": "\\\\",
@@ -94,8 +146,22 @@ def esc(m):
         return m
 
 
+class EscapeTable(dict):
+    """ A str.translate table applying esc, filled in as characters are seen. """
+
+    def __missing__(self, code):
+        escaped = esc(chr(code))
+        self[code] = escaped
+        return escaped
+
+
+# Filled in as output is escaped, so esc runs once per distinct character, and
+# only once a failure is reported.
+ESCAPE_TABLE = EscapeTable()
+
+
 def escape_string(s):
-    return "".join(esc(ch) for ch in s)
+    return s.translate(ESCAPE_TABLE)
 
 
 class CheckerError(Exception):
@@ -113,6 +179,8 @@ class CheckerError(Exception):
 class Line(object):
     """ A line that remembers where it came from. """
 
+    __slots__ = ("text", "number", "file")
+
     def __init__(self, text, number, file):
         self.text = text
         self.number = number
@@ -149,6 +217,15 @@ class RunCmd(object):
 
 
 class TestFailure(object):
+    __slots__ = (
+        "line",
+        "check",
+        "testrun",
+        "error_annotation_line",
+        "after",
+        "before",
+    )
+
     def __init__(self, line, check, testrun, before=None, after=None):
         self.line = line
         self.check = check
@@ -235,6 +312,157 @@ class TestFailure(object):
         """ Print our message to stdout. """
         print(self.message())
 
+    def kind(self):
+        """ Return what went wrong: "mismatch" if output failed to match a
+            check, "missing_output" if a check had no output left to match,
+            or "extra_output" if output was left after the last check.
+        """
+        if self.line and self.check:
+            return "mismatch"
+        return "missing_output" if self.check else "extra_output"
+
+    def to_dict(self):
+        """ Return the details of the failure as a JSON-compatible dict. """
+        data = {
+            "kind": self.kind(),
+            "name": self.testrun.name,
+            "run_lineno": self.testrun.runcmd.line.number,
+            "command": self.testrun.subbed_command,
+        }
+        if self.check:
+            data["check_type"] = self.check.type
+            data["input_file"] = self.check.line.file
+            data["input_lineno"] = self.check.line.number
+            data["input_line"] = self.check.line.text
+        if self.line:
+            data["output_file"] = self.line.file
+            data["output_lineno"] = self.line.number
+            data["output_line"] = self.line.text.rstrip("\n")
+        if self.error_annotation_line:
+            data["error_annotation_lineno"] = self.error_annotation_line.number
+            data["error_annotation"] = self.error_annotation_line.text.rstrip("\n")
+        after = (self.after or [])[: self.testrun.config.after]
+        data["before"] = [text.rstrip("\n") for text in self.before or []]
+        data["after"] = [text.rstrip("\n") for text in after]
+        return data
+
+
+class TimeoutFailure(TestFailure):
+    """ A failure because a command ran for longer than its timeout.
+
+    Attributes:
+        elapsed: seconds the command ran until it was killed.
+        stdout: the last lines the command wrote to stdout, escaped.
+        stderr: the last lines the command wrote to stderr, escaped.
+    """
+
+    __slots__ = ("elapsed", "stdout", "stderr")
+
+    def __init__(self, testrun, elapsed, stdout, stderr):
+        super(TimeoutFailure, self).__init__(None, None, testrun)
+        self.elapsed = elapsed
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def message(self):
+        fields = self.testrun.config.colors()
+        fields["name"] = self.testrun.name
+        fields["subbed_command"] = self.testrun.subbed_command
+        fields["timeout"] = "{:g}".format(self.testrun.timeout)
+        fields["elapsed"] = "{:.2f}".format(self.elapsed)
+        filemsg = "" if self.testrun.config.progress else " in {name}"
+        fmtstrs = [
+            "{RED}Failure{RESET}" + filemsg + ":",
+            "",
+            "  The command timed out after {elapsed} seconds (limit: {timeout} seconds).",
+            "",
+        ]
+        for stream, lines in (("stdout", self.stdout), ("stderr", self.stderr)):
+            if lines:
+                fields[stream] = "    ".join(lines)
+                fmtstrs += [
+                    "  Last output on " + stream + ":",
+                    "    {BOLD}{" + stream + "}{RESET}",
+                ]
+        fmtstrs += ["  when running command:", "    {subbed_command}"]
+        return "\n".join(fmtstrs).format(**fields)
+
+    def kind(self):
+        return "timeout"
+
+    def to_dict(self):
+        data = super(TimeoutFailure, self).to_dict()
+        data["timeout"] = self.testrun.timeout
+        data["elapsed"] = self.elapsed
+        data["stdout"] = [text.rstrip("\n") for text in self.stdout]
+        data["stderr"] = [text.rstrip("\n") for text in self.stderr]
+        return data
+
+
+def format_size(size):
+    """ Return a number of bytes as text with a binary unit. """
+    for unit in ("bytes", "KiB", "MiB"):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "GiB"
+    return "{:.4g} {}".format(size, unit)
+
+
+class BudgetFailure(TestFailure):
+    """ A failure because a command used more than a MAXTIME, MAXCPU or
+        MAXRSS line of its file allows.
+
+    Attributes:
+        budget: the directive, e.g. "MAXRSS".
+        measured: what the command used, in seconds or bytes.
+        limit: what the directive allows, in the same unit.
+    """
+
+    __slots__ = ("budget", "measured", "limit")
+
+    def __init__(self, testrun, budget, measured, limit):
+        super(BudgetFailure, self).__init__(None, None, testrun)
+        self.budget = budget
+        self.measured = measured
+        self.limit = limit
+
+    def message(self):
+        fields = self.testrun.config.colors()
+        fields["name"] = self.testrun.name
+        fields["subbed_command"] = self.testrun.subbed_command
+        fields["budget"] = self.budget
+        if self.budget == "MAXRSS":
+            fields["what"] = "peak memory"
+            fields["measured"] = format_size(self.measured)
+            fields["limit"] = format_size(self.limit)
+        else:
+            fields["what"] = "wall time" if self.budget == "MAXTIME" else "CPU time"
+            fields["measured"] = "{:.3f} seconds".format(self.measured)
+            fields["limit"] = "{:g} seconds".format(self.limit)
+        filemsg = "" if self.testrun.config.progress else " in {name}"
+        fmtstrs = [
+            "{RED}Failure{RESET}" + filemsg + ":",
+            "",
+            "  The {budget} budget was exceeded: the command's {what} was",
+            "    {BOLD}{measured}{RESET} (limit: {limit})",
+            "",
+            "  when running command:",
+            "    {subbed_command}",
+        ]
+        return "\n".join(fmtstrs).format(**fields)
+
+    def kind(self):
+        return "budget"
+
+    def to_dict(self):
+        data = super(BudgetFailure, self).to_dict()
+        data["budget"] = self.budget
+        data["measured"] = self.measured
+        data["limit"] = self.limit
+        return data
+
 
 def perform_substitution(input_str, subs):
     """ Perform the substitutions described by subs to str
@@ -258,98 +486,506 @@ def perform_substitution(input_str, subs):
     return re.sub(r"%(%|[a-zA-Z0-9_-]+)", subber, input_str)
 
 
+def line_starts(data, newline):
+    """ Return an array of the offsets in data (a string or bytes-like object)
+        where lines start, splitting by newline.
+    """
+    from array import array
+
+    starts = array("q", [0])
+    find = data.find
+    pos = find(newline)
+    while pos >= 0:
+        pos += 1
+        starts.append(pos)
+        pos = find(newline, pos)
+    return starts
+
+
+class OutputBuffer(object):
+    """ The decoded output of a command, kept as one string instead of a
+        string per line. Lines are split off while iterating, and the array
+        of offsets where they start, needed for random access, is only
+        computed on demand.
+
+    Lines are split by newlines only, retaining the newlines. The text after
+    the last newline is a line too, even if it is empty, and gets a newline
+    appended.
+    """
+
+    __slots__ = ("text", "_starts")
+
+    def __init__(self, data, errors="strict"):
+        self.text = data.decode("utf-8", errors)
+        self._starts = None
+
+    @property
+    def starts(self):
+        if self._starts is None:
+            self._starts = line_starts(self.text, "\n")
+        return self._starts
+
+    def __len__(self):
+        return len(self.starts)
+
+    def line(self, idx):
+        """ Return the line with the given 0-based index. """
+        starts = self.starts
+        if idx + 1 < len(starts):
+            return self.text[starts[idx] : starts[idx + 1]]
+        return self.text[starts[idx] :] + "\n"
+
+    def __iter__(self):
+        text = self.text
+        find = text.find
+        start = 0
+        end = find("\n")
+        while end >= 0:
+            end += 1
+            yield text[start:end]
+            start = end
+            end = find("\n", start)
+        yield text[start:] + "\n"
+
+
+class MappedOutput(object):
+    """ The output of a command that was written to a file, mapped into
+        memory and decoded a line at a time. It has the same interface as
+        OutputBuffer, but the offsets are of bytes.
+    """
+
+    __slots__ = ("data", "errors", "_starts")
+
+    def __init__(self, file, errors="strict"):
+        import mmap
+
+        file.flush()
+        size = os.fstat(file.fileno()).st_size
+        # Empty files can't be mapped.
+        self.data = b""
+        if size:
+            self.data = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        self.errors = errors
+        self._starts = None
+
+    @property
+    def starts(self):
+        if self._starts is None:
+            self._starts = line_starts(self.data, b"\n")
+        return self._starts
+
+    def __len__(self):
+        return len(self.starts)
+
+    def line(self, idx):
+        """ Return the line with the given 0-based index. """
+        starts = self.starts
+        if idx + 1 < len(starts):
+            return self.data[starts[idx] : starts[idx + 1]].decode("utf-8", self.errors)
+        return self.data[starts[idx] :].decode("utf-8", self.errors) + "\n"
+
+    def __iter__(self):
+        data = self.data
+        errors = self.errors
+        find = data.find
+        start = 0
+        end = find(b"\n")
+        while end >= 0:
+            end += 1
+            yield data[start:end].decode("utf-8", errors)
+            start = end
+            end = find(b"\n", start)
+        yield data[start:].decode("utf-8", errors) + "\n"
+
+
 class TestRun(object):
     def __init__(self, name, runcmd, checker, subs, config):
         self.name = name
         self.runcmd = runcmd
+        # Where the time goes when running, if config.profile is set.
+        self.profile = Profile() if config.profile else None
         self.subbed_command = perform_substitution(runcmd.args, subs)
+        # The arguments to run the command with directly, or None if it
+        # needs a shell.
+        self.argv = direct_argv(self.subbed_command) if config.direct_exec else None
+        if self.profile:
+            self.profile.lap("substitute")
         self.checker = checker
         self.subs = subs
         self.config = config
+        # A TIMEOUT line in the file takes precedence over the global timeout.
+        self.timeout = checker.timeout
+        if self.timeout is None:
+            self.timeout = config.timeout
+        # Commands that we might have to kill get a process group of their own,
+        # so we can kill everything they started.
+        self.own_group = (
+            self.timeout is not None or config.fail_early or config.cancel is not None
+        )
+        # The TestFailure once run, or None.
+        self.failure = None
+        # Whether the run was skipped because it passed before with the same inputs.
+        self.cached = False
+        # The fingerprint of its inputs, once IncrementalState.is_fresh saw it.
+        self.fingerprint = None
+        # Seconds the run took, or None if it did not run.
+        self.duration = None
+        # Whether the run was skipped or stopped because of too many failures.
+        self.cancelled = False
+        # Whether we need the resources the command used, and those once known:
+        # a dict like Profile.usage.
+        self.measure = (
+            config.profile
+            or checker.maxcpu
+            or checker.maxrss
+            or config.repeat > 1
+            or config.warmup > 0
+        )
+        self.usage = None
+        # Seconds from starting the command until it exited, once it did.
+        self.wall = None
+        # With config.repeat or config.warmup, the (wall, cpu) seconds of
+        # each measured run. cpu is None where it can't be measured.
+        self.samples = None
 
     def check(self, lines, checks):
-        # Reverse our lines and checks so we can pop off the end.
-        lineq = lines[::-1]
-        checkq = checks[::-1]
-        # We keep the last couple of lines in a deque so we can show context.
-        before = deque(maxlen=self.config.before)
-        while lineq and checkq:
-            line = lineq[-1]
-            check = checkq[-1]
-            if check.regex.match(line.text):
-                # This line matched this checker, continue on.
-                lineq.pop()
-                checkq.pop()
-                before.append(line)
-            elif line.is_empty_space():
-                # Skip all whitespace input lines.
-                lineq.pop()
+        """ Match a list of Lines against checks. Return a TestFailure, or None. """
+        matcher = OutputMatcher(self, checks, lines[0].file if lines else "stdout")
+        for line in lines:
+            if matcher.feed(line.text, line.number):
+                break
+        return matcher.finish()
+
+    def check_output(self, output, checks, stream):
+        """ Match an OutputBuffer with the output on stream ("stdout" or
+            "stderr") against checks. Return a TestFailure, or None.
+        """
+        matcher = OutputMatcher(self, checks, stream)
+        feed = matcher.feed
+        number = 0
+        # The output is decoded and split lazily, so once the result is known
+        # the rest of it is never looked at.
+        for text in output:
+            number += 1
+            if feed(text, number):
+                break
+        return matcher.finish()
+
+    def pump(self, proc, outsink, errsink, deadline=None):
+        """ Read the stdout and stderr of proc as data arrives, passing each
+            chunk to outsink or errsink. An empty chunk signals end of file.
+            A sink may return True to ask to stop reading, or set its deadline
+            attribute to stop at that time.monotonic() value.
+            Return "stopped" if a sink asked to stop, "timeout" if the deadline
+            (a time.monotonic() value) passed first, or None once both streams
+            are closed.
+        """
+        import selectors
+
+        sel = selectors.DefaultSelector()
+        for stream, sink in ((proc.stdout, outsink), (proc.stderr, errsink)):
+            if not stream.closed:
+                sel.register(stream, selectors.EVENT_READ, sink)
+        try:
+            while sel.get_map():
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        return "timeout"
+                for sink in (outsink, errsink):
+                    stop_at = getattr(sink, "deadline", None)
+                    if stop_at is not None:
+                        remaining = stop_at - time.monotonic()
+                        if remaining <= 0:
+                            return "stopped"
+                        if timeout is None or remaining < timeout:
+                            timeout = remaining
+                for key, _ in sel.select(timeout):
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                    if key.data(data):
+                        return "stopped"
+            return None
+        finally:
+            sel.close()
+
+    def kill(self, proc):
+        """ Kill proc, and everything it started if it has its own process group. """
+        try:
+            if self.own_group:
+                os.killpg(proc.pid, signal.SIGKILL)
             else:
-                # Failed to match.
-                lineq.pop()
-                line.text = escape_string(line.text.strip()) + "\n"
-                # Add context, ignoring empty lines.
-                return TestFailure(
-                    line,
-                    check,
-                    self,
-                    before=[escape_string(line.text.strip()) + "\n" for line in before],
-                    after=[
-                        escape_string(line.text.strip()) + "\n"
-                        for line in lineq[::-1]
-                        if not line.is_empty_space()
-                    ],
-                )
-        # Drain empties.
-        while lineq and lineq[-1].is_empty_space():
-            lineq.pop()
-        # If there's still lines or checkers, we have a failure.
-        # Otherwise it's success.
-        if lineq:
-            return TestFailure(lineq[-1], None, self)
-        elif checkq:
-            return TestFailure(None, checkq[-1], self)
+                proc.kill()
+        except OSError:
+            # It's already gone.
+            pass
+
+    def wait(self, proc, timeout=None):
+        """ Wait for proc to exit and return its exit status, like proc.wait.
+            When profiling or checking budgets, also record the resources it
+            and its children used in self.usage.
+        """
+        if not self.measure or not hasattr(os, "wait4") or proc.returncode is not None:
+            return proc.wait(timeout)
+        # Poll like proc.wait does with a timeout, but with os.wait4 so we
+        # get the rusage of the child.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0005
+        try:
+            while True:
+                flags = 0 if deadline is None else os.WNOHANG
+                pid, status, rusage = os.wait4(proc.pid, flags)
+                if pid:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(proc.args, timeout)
+                delay = min(delay * 2, remaining, 0.05)
+                time.sleep(delay)
+        except ChildProcessError:
+            # Reaped elsewhere, so there is no rusage to get.
+            return proc.wait()
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
         else:
-            return None
+            proc.returncode = os.WEXITSTATUS(status)
+        maxrss = rusage.ru_maxrss
+        # Linux reports KiB, macOS bytes.
+        if sys.platform == "darwin":
+            maxrss //= 1024
+        self.usage = {
+            "user": rusage.ru_utime,
+            "system": rusage.ru_stime,
+            "maxrss": maxrss,
+        }
+        if self.profile:
+            self.profile.usage = self.usage
+        return proc.returncode
+
+    def spawn(self, stdout, stderr):
+        """ Start the command, without a shell if it needs none. Return the Popen. """
+        kwargs = {
+            "stdin": subprocess.PIPE,
+            "stdout": stdout,
+            "stderr": stderr,
+            "close_fds": True,
+            "start_new_session": self.own_group,
+            "cwd": self.config.cwd,
+            "env": self.config.env,
+        }
+        if self.argv:
+            try:
+                return subprocess.Popen(self.argv, **kwargs)
+            except FileNotFoundError:
+                raise CheckerError("Command could not be found: " + self.subbed_command)
+            except OSError:
+                # E.g. a script without a #! line, which only a shell will run.
+                pass
+        return subprocess.Popen(self.subbed_command, shell=True, **kwargs)
 
     def run(self):
         """ Run the command. Return a TestFailure, or None. """
-
-        def split_by_newlines(s):
-            """ Decode a string and split it by newlines only,
-                retaining the newlines.
-            """
-            return [s + "\n" for s in s.decode("utf-8").split("\n")]
-
         PIPE = subprocess.PIPE
+        profile = self.profile
+        if profile:
+            profile.start()
         if self.config.verbose:
             print(self.subbed_command)
-        proc = subprocess.Popen(
-            self.subbed_command,
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=PIPE,
-            shell=True,
-            close_fds=True,  # For Python 2.6 as shipped on RHEL 6
-        )
-        stdout, stderr = proc.communicate()
+        # Commands we might have to kill or measure need a process of their own.
+        # The --persistent-shell help lists what makes them so.
+        if self.config.shells and not self.own_group and not self.measure:
+            shell = self.config.shells.get()
+            try:
+                return self.run_in_shell(shell)
+            finally:
+                self.config.shells.release(shell)
+        # With a spill directory, the command writes straight to files there,
+        # unless we have to look at the output while it is produced.
+        spill_dir = None if self.config.fail_early else self.config.spill_dir
+        if spill_dir:
+            import tempfile
+
+            outsink = OutputSink(self.config, tempfile.TemporaryFile(dir=spill_dir))
+            errsink = OutputSink(self.config, tempfile.TemporaryFile(dir=spill_dir))
+            stdout, stderr = outsink.file, errsink.file
+        else:
+            stdout = stderr = PIPE
+        proc = self.spawn(stdout, stderr)
+        try:
+            if self.config.cancel:
+                self.config.cancel.start(self, proc)
+            # We never send input.
+            proc.stdin.close()
+            if profile:
+                profile.lap("spawn")
+            starttime = time.monotonic()
+            deadline = None if self.timeout is None else starttime + self.timeout
+            if self.config.fail_early:
+                # Match the output while it is produced, and stop the command
+                # as soon as a failure on stdout and its context are known.
+                # A failure on stdout is reported in preference to one on stderr,
+                # so we can't stop at the latter, but we do stop looking at stderr.
+                outmatcher = OutputMatcher(self, self.checker.outchecks, "stdout")
+                errmatcher = OutputMatcher(self, self.checker.errchecks, "stderr")
+                outsink = LineFeeder(outmatcher, True)
+                errsink = LineFeeder(errmatcher, False)
+            elif not spill_dir:
+                outsink = OutputSink(self.config)
+                errsink = OutputSink(self.config)
+            if spill_dir:
+                stopped = None
+                try:
+                    self.wait(proc, None if deadline is None else self.timeout)
+                except subprocess.TimeoutExpired:
+                    stopped = "timeout"
+            else:
+                stopped = self.pump(proc, outsink, errsink, deadline)
+            if stopped:
+                self.kill(proc)
+            if stopped == "timeout":
+                elapsed = time.monotonic() - starttime
+                # Collect what the command managed to write before it was killed,
+                # without waiting forever for anything that escaped its process group.
+                if not spill_dir:
+                    self.pump(proc, outsink, errsink, time.monotonic() + 1)
+            if not spill_dir:
+                proc.stdout.close()
+                proc.stderr.close()
+                if stopped is None and deadline is not None:
+                    # The command may have closed its output and kept running.
+                    try:
+                        self.wait(proc, max(deadline - time.monotonic(), 0))
+                    except subprocess.TimeoutExpired:
+                        stopped = "timeout"
+                        elapsed = time.monotonic() - starttime
+                        self.kill(proc)
+            status = self.wait(proc)
+        except BaseException:
+            # Don't leave the command running if anything goes wrong, like
+            # output that is not UTF-8 with --fail-early.
+            self.kill(proc)
+            for stream in (proc.stdout, proc.stderr):
+                if stream:
+                    stream.close()
+            proc.wait()
+            if self.config.cancel:
+                self.config.cancel.finish(self)
+            raise
+        if profile:
+            profile.lap("wait")
+        if self.config.cancel:
+            self.config.cancel.finish(self)
+            if self.cancelled:
+                return None
+        if stopped == "timeout":
+            if self.config.fail_early:
+                outtail, errtail = outsink.tail, errsink.tail
+            else:
+                # The command may have been killed in the middle of a character.
+                outtail = outsink.output("replace")
+                errtail = errsink.output("replace")
+            return TimeoutFailure(
+                self,
+                elapsed,
+                last_lines(outtail, self.config.before),
+                last_lines(errtail, self.config.before),
+            )
         # HACK: This is quite cheesy: POSIX specifies that sh should return 127 for a missing command.
         # Technically it's also possible to return it in other conditions.
         # Practically, that's *probably* not going to happen.
-        status = proc.returncode
+        # Without a shell, a missing command already failed in spawn.
+        shell = not isinstance(proc.args, list)
+        if status == 127 and shell and not stopped:
+            raise CheckerError("Command could not be found: " + self.subbed_command)
+
+        wall = self.wall = time.monotonic() - starttime
+        if self.config.fail_early:
+            # If we stopped the command, output that is missing is not a failure.
+            outfail = outmatcher.finish(complete=not stopped)
+            errfail = errmatcher.finish(complete=not stopped)
+            if profile:
+                profile.lap("match")
+            failure = self.first_failure(outfail, errfail)
+        else:
+            failure = self.check_sinks(outsink, errsink)
+        return failure or self.check_budgets(wall)
+
+    def run_in_shell(self, shell):
+        """ Run the command in a ShellSession. Return a TestFailure, or None. """
+        starttime = time.monotonic()
+        status, outfile, errfile = shell.run(self.subbed_command, self.config.cwd)
+        wall = self.wall = time.monotonic() - starttime
+        if self.profile:
+            self.profile.lap("wait")
         if status == 127:
             raise CheckerError("Command could not be found: " + self.subbed_command)
+        failure = self.check_sinks(
+            OutputSink(self.config, outfile), OutputSink(self.config, errfile)
+        )
+        return failure or self.check_budgets(wall)
+
+    def benchmark(self):
+        """ Run the command config.warmup times and then config.repeat times,
+            recording self.samples of the latter.
+            Return the first TestFailure, or None. With config.check_first,
+            only the first run's output is checked.
+        """
+        config = self.config
+        self.samples = []
+        for i in range(config.warmup + config.repeat):
+            failure = self.run()
+            if self.cancelled:
+                return None
+            # Timeouts and budgets apply to every run.
+            ignored = config.check_first and i and type(failure) is TestFailure
+            if failure and not ignored:
+                return failure
+            if i >= config.warmup:
+                usage = self.usage
+                cpu = None if usage is None else usage["user"] + usage["system"]
+                self.samples.append((self.wall, cpu))
+        return None
+
+    def check_budgets(self, wall):
+        """ Check the wall time in seconds and the resources the command used
+            against the budgets of the file. Return a BudgetFailure, or None.
+        """
+        checker = self.checker
+        if checker.maxtime is not None and wall > checker.maxtime:
+            return BudgetFailure(self, "MAXTIME", wall, checker.maxtime)
+        usage = self.usage
+        if usage is None:
+            # Without os.wait4, there is nothing to check.
+            return None
+        cpu = usage["user"] + usage["system"]
+        if checker.maxcpu is not None and cpu > checker.maxcpu:
+            return BudgetFailure(self, "MAXCPU", cpu, checker.maxcpu)
+        rss = usage["maxrss"] * 1024
+        if checker.maxrss is not None and rss > checker.maxrss:
+            return BudgetFailure(self, "MAXRSS", rss, checker.maxrss)
+        return None
+
+    def check_sinks(self, outsink, errsink):
+        """ Match the output collected in OutputSinks against the checks.
+            Return a TestFailure, or None.
+        """
+        profile = self.profile
+        out = outsink.output()
+        err = errsink.output()
+        if profile:
+            profile.lap("decode")
+        outfail = self.check_output(out, self.checker.outchecks, "stdout")
+        errfail = self.check_output(err, self.checker.errchecks, "stderr")
+        if profile:
+            profile.lap("match")
+        return self.first_failure(outfail, errfail)
 
-        outlines = [
-            Line(text, idx + 1, "stdout")
-            for idx, text in enumerate(split_by_newlines(stdout))
-        ]
-        errlines = [
-            Line(text, idx + 1, "stderr")
-            for idx, text in enumerate(split_by_newlines(stderr))
-        ]
-        outfail = self.check(outlines, self.checker.outchecks)
-        errfail = self.check(errlines, self.checker.errchecks)
+    @staticmethod
+    def first_failure(outfail, errfail):
+        """ Return the failure to report, given those on stdout and stderr. """
         # It's possible that something going wrong on stdout resulted in new
         # text being printed on stderr. If we have an outfailure, and either
         # non-matching or unmatched stderr text, then annotate the outfail
@@ -359,11 +995,328 @@ class TestRun(object):
         return outfail if outfail else errfail
 
 
+class ShellSession(object):
+    """ A long-running /bin/sh that runs commands one after the other, each
+        in a subshell of its own, which is faster to start than a new shell.
+
+    Each command is written to a script file, which the subshell sources
+    with its stdout and stderr redirected to files of their own and its
+    stdin from /dev/null. The shell then prints a sentinel and the exit
+    status on its stdout, which only we read.
+    """
+
+    def __init__(self, env=None):
+        import binascii
+        import tempfile
+
+        self.directory = tempfile.mkdtemp(prefix="littlecheck-")
+        self.sentinel = "littlecheck-" + binascii.hexlify(os.urandom(8)).decode()
+        self.count = 0
+        self.proc = subprocess.Popen(
+            ["/bin/sh"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            close_fds=True,
+            env=env,
+        )
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, command, cwd=None):
+        """ Run command in a subshell, in directory cwd if given.
+            Return its exit status and the files with its stdout and stderr,
+            which the caller has to close.
+        """
+        self.count += 1
+        base = os.path.join(self.directory, str(self.count))
+        script, out, err = base + ".sh", base + ".out", base + ".err"
+        with io.open(script, "w", encoding="utf-8") as fd:
+            fd.write(command + "\n")
+        cd = "cd -- {} && ".format(shlex.quote(cwd)) if cwd else ""
+        line = '( {}. {} ) >{} 2>{} </dev/null; echo "{} $?"\n'.format(
+            cd, shlex.quote(script), shlex.quote(out), shlex.quote(err), self.sentinel
+        )
+        try:
+            self.proc.stdin.write(line.encode("utf-8"))
+            self.proc.stdin.flush()
+            reply = self.proc.stdout.readline().decode("utf-8").split()
+        except (IOError, OSError):
+            reply = []
+        if len(reply) != 2 or reply[0] != self.sentinel:
+            raise CheckerError("The shell exited while running: " + command)
+        files = []
+        for path in (out, err):
+            files.append(io.open(path, "rb"))
+            # The open file is all we need.
+            os.unlink(path)
+        os.unlink(script)
+        return int(reply[1]), files[0], files[1]
+
+    def close(self):
+        import shutil
+
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ShellSessions(object):
+    """ The ShellSessions of all threads that run commands. A thread takes an
+        idle one with get() and gives it back with release(), so there are
+        only as many shells as commands ever ran at the same time, however
+        many threads come and go.
+    """
+
+    def __init__(self, env=None):
+        import threading
+
+        self.env = env
+        self.sessions = []
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        """ Return an idle ShellSession, starting one if there is none. """
+        with self.lock:
+            while self.idle:
+                session = self.idle.pop()
+                if session.alive():
+                    return session
+        session = ShellSession(self.env)
+        with self.lock:
+            self.sessions.append(session)
+        return session
+
+    def release(self, session):
+        """ Make session, taken with get(), available to other commands. """
+        with self.lock:
+            self.idle.append(session)
+
+    def close(self):
+        """ Stop all shells. """
+        with self.lock:
+            for session in self.sessions:
+                session.close()
+            del self.sessions[:]
+            del self.idle[:]
+
+
+class OutputSink(object):
+    """ A sink for TestRun.pump that keeps the output of a command in memory
+        until it grows past config.spill_threshold bytes, and then moves it to
+        a temporary file in config.spill_dir.
+
+    Attributes:
+        file: the file holding the output, or None while it is in memory.
+            If given initially, the command writes to it directly.
+    """
+
+    def __init__(self, config, file=None):
+        self.config = config
+        self.file = file
+        self.chunks = []
+        self.size = 0
+
+    def __call__(self, data):
+        if self.file:
+            self.file.write(data)
+            return False
+        self.chunks.append(data)
+        self.size += len(data)
+        threshold = self.config.spill_threshold
+        if threshold is not None and self.size > threshold:
+            import tempfile
+
+            self.file = tempfile.TemporaryFile(dir=self.config.spill_dir)
+            for chunk in self.chunks:
+                self.file.write(chunk)
+            del self.chunks[:]
+        return False
+
+    def output(self, errors="strict"):
+        """ Return the output as an OutputBuffer or MappedOutput. """
+        if self.file is None:
+            data = b"".join(self.chunks)
+            # Free the chunks early.
+            del self.chunks[:]
+            return OutputBuffer(data, errors)
+        with self.file:
+            return MappedOutput(self.file, errors)
+
+
+def last_lines(lines, count):
+    """ Return the last count non-empty lines of lines, escaped. """
+    result = deque(maxlen=count)
+    for text in lines:
+        if text and not text.isspace():
+            result.append(text)
+    return [escape_string(text.strip()) + "\n" for text in result]
+
+
+class OutputMatcher(object):
+    """ Matches the lines of one output stream against a list of checks,
+        one line at a time.
+
+    Empty lines that don't match are skipped. Once a line fails to match,
+    up to config.after following non-empty lines are collected as context,
+    but at least one, since TestFailure.message shows the context only if
+    there is some.
+
+    Attributes:
+        failure: the TestFailure found so far, or None.
+        done: whether the result is final, i.e. a failure has been found and
+            enough context has been collected to report it.
+    """
+
+    def __init__(self, testrun, checks, stream):
+        self.testrun = testrun
+        self.checks = checks
+        self.stream = stream
+        self.checkidx = 0
+        # We keep the last couple of lines in a deque so we can show context.
+        self.before = deque(maxlen=testrun.config.before)
+        self.failure = None
+        self.done = False
+
+    def feed(self, text, number):
+        """ Match the next line of output. Return self.done. """
+        failure = self.failure
+        if failure:
+            # Add context, ignoring empty lines.
+            if failure.after is not None and text and not text.isspace():
+                failure.after.append(escape_string(text.strip()) + "\n")
+                self.done = len(failure.after) >= max(self.testrun.config.after, 1)
+            return self.done
+        if self.checkidx == len(self.checks):
+            if text and not text.isspace():
+                # There are no checks left to match this line.
+                line = Line(text, number, self.stream)
+                self.failure = TestFailure(line, None, self.testrun)
+                self.done = True
+        elif self.checks[self.checkidx].matches(text):
+            # This line matched this checker, continue on.
+            self.checkidx += 1
+            self.before.append(text)
+        elif text and not text.isspace():
+            # Failed to match.
+            self.failure = TestFailure(
+                Line(escape_string(text.strip()) + "\n", number, self.stream),
+                self.checks[self.checkidx],
+                self.testrun,
+                before=[escape_string(t.strip()) + "\n" for t in self.before],
+                after=[],
+            )
+        return self.done
+
+    def finish(self, complete=True):
+        """ Return the TestFailure once all output has been fed, or None on success.
+            If complete is False, the output was cut short, so unmatched checks
+            are not reported.
+        """
+        if self.failure:
+            return self.failure
+        if complete and self.checkidx < len(self.checks):
+            return TestFailure(None, self.checks[self.checkidx], self.testrun)
+        return None
+
+
+class LineFeeder(object):
+    """ A sink for TestRun.pump that splits a byte stream into lines
+        and feeds them, decoded, to an OutputMatcher.
+
+    Once the matcher is done, the rest of the stream is discarded. If stop
+    is set, the feeder then asks pump to stop reading. It also does so once
+    the matcher has found a failure and waited GRACE seconds for the lines
+    after it, so a command that hangs after a mismatch is stopped too.
+
+    Attributes:
+        tail: the last few non-empty lines, to show if the command times out.
+        deadline: when pump should stop waiting for context, or None.
+    """
+
+    GRACE = 0.2
+
+    def __init__(self, matcher, stop):
+        self.matcher = matcher
+        self.stop = stop
+        self.pending = []
+        self.number = 0
+        self.tail = deque(maxlen=matcher.testrun.config.before)
+        self.deadline = None
+
+    def __call__(self, data):
+        if self.matcher.done:
+            return self.stop
+        if not data:
+            # Like in OutputBuffer, the text after the last newline
+            # is a line too, even if it is empty.
+            return self.feed_line(b"".join(self.pending))
+        self.pending.append(data)
+        if b"\n" not in data:
+            return False
+        lines = b"".join(self.pending).split(b"\n")
+        self.pending = [lines.pop()]
+        for line in lines:
+            if self.feed_line(line):
+                return True
+        return False
+
+    def feed_line(self, line):
+        self.number += 1
+        text = line.decode("utf-8") + "\n"
+        if not text.isspace():
+            self.tail.append(text)
+        done = self.matcher.feed(text, self.number)
+        if self.stop and self.matcher.failure and self.deadline is None:
+            self.deadline = time.monotonic() + self.GRACE
+        return done and self.stop
+
+
 class CheckCmd(object):
-    def __init__(self, line, checktype, regex):
+    """ A CHECK or CHECKERR line.
+
+    Attributes:
+        line: the Line it is on.
+        type: "CHECK" or "CHECKERR".
+        regex: the regular expression an output line has to match.
+        literal: if the check has no {{...}}, its text, which an output line
+            has to equal once stripped of surrounding whitespace; else None.
+        prefix: the literal text before the first {{...}}, which an output
+            line has to start with after leading whitespace; or "".
+    """
+
+    __slots__ = ("line", "type", "_regex", "literal", "prefix")
+
+    def __init__(self, line, checktype, regex, literal=None, prefix=""):
         self.line = line
         self.type = checktype
-        self.regex = regex
+        # A compiled regex, or a pattern that is compiled when needed.
+        self._regex = regex
+        self.literal = literal
+        self.prefix = prefix
+
+    @property
+    def regex(self):
+        if not hasattr(self._regex, "match"):
+            self._regex = re.compile(self._regex)
+        return self._regex
+
+    @property
+    def pattern(self):
+        return getattr(self._regex, "pattern", self._regex)
+
+    def matches(self, text):
+        """ Return whether the output line text matches, like regex.match. """
+        if self.literal is not None:
+            return text.strip() == self.literal
+        if self.prefix and not text.lstrip().startswith(self.prefix):
+            return False
+        return self.regex.match(text) is not None
 
     @staticmethod
     def parse(line, checktype):
@@ -374,15 +1327,18 @@ class CheckCmd(object):
         # evens will be literals.
         # Note that if {{...}} appears first we will get an empty string in
         # the split array, so the {{...}} matches are always at odd indexes.
-        bracket_re = re.compile(
-            r"""
-                \{\{   # Two open brackets
-                (.*?)  # Nongreedy capture
-                \}\}   # Two close brackets
-            """,
-            re.VERBOSE,
-        )
-        pieces = bracket_re.split(line.text)
+        pieces = BRACKET_RE.split(line.text)
+        # The fast paths in matches() rely on the literal text starting (and
+        # for a literal, ending) with something other than whitespace, so
+        # the \s* around it can only match the whitespace around the line.
+        first = pieces[0]
+        literal = None
+        prefix = ""
+        if "\n" not in first and first == first.lstrip():
+            if len(pieces) == 1 and first == first.rstrip():
+                literal = first
+            elif len(pieces) > 1:
+                prefix = first
         even = True
         re_strings = []
         for piece in pieces:
@@ -408,55 +1364,1399 @@ class CheckCmd(object):
         # We need the anchors because Python's match() matches an arbitrary prefix,
         # not the entire string.
         re_strings = [r"^\s*"] + re_strings + [r"\s*\n?$"]
-        full_re = re.compile("".join(re_strings))
-        return CheckCmd(line, checktype, full_re)
+        full_re = "".join(re_strings)
+        # A literal's regex is rarely needed, so it is compiled on demand.
+        if literal is None:
+            full_re = re.compile(full_re)
+        return CheckCmd(line, checktype, full_re, literal, prefix)
+
+
+# A size like "512M" or "2.5GiB". Without a unit, it is in bytes.
+SIZE_RE = re.compile(r"\s*(\d+(?:\.\d*)?)\s*(?:([KMGkmg])i?)?B?\s*$")
+
+
+def parse_seconds(line, directive):
+    """ Return the positive number of seconds on a directive's Line. """
+    try:
+        seconds = float(line.text)
+    except ValueError:
+        seconds = -1
+    if not seconds > 0:
+        raise CheckerError("Invalid %s: '%s'" % (directive, line.text), line)
+    return seconds
 
 
 class Checker(object):
     def __init__(self, name, lines):
-        self.name = name
-        # Helper to yield subline containing group1 from all matching lines.
-        def group1s(regex):
-            for line in lines:
-                m = regex.match(line.text)
+        # Find the directives in a single pass. Most lines are not comments,
+        # so a cheap test rejects them before the regex runs.
+        directives = dict((directive, []) for directive in DIRECTIVES)
+        for line in lines:
+            if "#" in line.text:
+                m = DIRECTIVE_RE.match(line.text)
                 if m:
-                    yield line.subline(m.group(1))
+                    directives[m.group(1)].append(line.subline(m.group(2)))
+        self.parse_directives(name, directives, lines[0] if lines else None)
+
+    @staticmethod
+    def from_text(name, text):
+        """ Return the Checker for a file, given its contents as one string.
+            Unlike the constructor, this doesn't make a Line for each line
+            of the file, only for the directives.
+        """
+        directives = dict((directive, []) for directive in DIRECTIVES)
+        lineno = 1
+        pos = 0
+        for m in DIRECTIVE_SCAN_RE.finditer(text):
+            lineno += text.count("\n", pos, m.start())
+            pos = m.start()
+            directives[m.group(1)].append(Line(m.group(2), lineno, name))
+        first_line = None
+        if text:
+            first_line = Line(text[: text.find("\n") + 1 or len(text)], 1, name)
+        checker = Checker.__new__(Checker)
+        checker.parse_directives(name, directives, first_line)
+        return checker
+
+    def parse_directives(self, name, directives, first_line):
+        """ Initialize from the sublines of each directive, and the first line
+            of the file (or None if it is empty).
+        """
+        self.name = name
+        # A hash of the file's contents, if known.
+        self.digest = None
 
         # Find run commands.
-        self.runcmds = [RunCmd.parse(sl) for sl in group1s(RUN_RE)]
+        self.runcmds = [RunCmd.parse(sl) for sl in directives["RUN"]]
         if not self.runcmds:
             # If no RUN command has been given, fall back to the shebang.
-            if lines[0].text.startswith("#!"):
+            if first_line and first_line.text.startswith("#!"):
                 # Remove the "#!" at the beginning, and the newline at the end.
-                self.runcmds = [RunCmd(lines[0].text[2:-1] + " %s", lines[0])]
+                self.runcmds = [RunCmd(first_line.text[2:-1] + " %s", first_line)]
             else:
                 raise CheckerError("No runlines ('# RUN') found")
 
         # Find check cmds.
-        self.outchecks = [
-            CheckCmd.parse(sl, "CHECK") for sl in group1s(CHECK_STDOUT_RE)
-        ]
+        self.outchecks = [CheckCmd.parse(sl, "CHECK") for sl in directives["CHECK"]]
         self.errchecks = [
-            CheckCmd.parse(sl, "CHECKERR") for sl in group1s(CHECK_STDERR_RE)
+            CheckCmd.parse(sl, "CHECKERR") for sl in directives["CHECKERR"]
+        ]
+
+        # Find the timeout. If there are several, the last one wins.
+        self.timeout = None
+        for sl in directives["TIMEOUT"]:
+            self.timeout = parse_seconds(sl, "TIMEOUT")
+
+        # Find the budgets of each command, in seconds and bytes.
+        # Again, the last one wins.
+        self.maxtime = self.maxcpu = self.maxrss = None
+        for sl in directives["MAXTIME"]:
+            self.maxtime = parse_seconds(sl, "MAXTIME")
+        for sl in directives["MAXCPU"]:
+            self.maxcpu = parse_seconds(sl, "MAXCPU")
+        for sl in directives["MAXRSS"]:
+            m = SIZE_RE.match(sl.text)
+            if m:
+                unit = 1024 ** " KMG".index((m.group(2) or " ").upper())
+                self.maxrss = int(float(m.group(1)) * unit)
+            if not m or not self.maxrss > 0:
+                raise CheckerError("Invalid MAXRSS: '%s'" % sl.text, sl)
+
+    def to_dict(self):
+        """ Return the parsed contents as a JSON-serializable dictionary,
+            from which from_dict can rebuild the Checker without parsing.
+        """
+
+        def checks(cmds):
+            return [
+                [c.line.text, c.line.number, c.pattern, c.literal, c.prefix]
+                for c in cmds
+            ]
+
+        return {
+            "runcmds": [[r.args, r.line.text, r.line.number] for r in self.runcmds],
+            "outchecks": checks(self.outchecks),
+            "errchecks": checks(self.errchecks),
+            "timeout": self.timeout,
+            "maxtime": self.maxtime,
+            "maxcpu": self.maxcpu,
+            "maxrss": self.maxrss,
+        }
+
+    @staticmethod
+    def from_dict(name, data):
+        """ Return a Checker for the file called name from the result of to_dict. """
+
+        def checks(items, checktype):
+            return [
+                CheckCmd(Line(text, number, name), checktype, pattern, literal, prefix)
+                for text, number, pattern, literal, prefix in items
+            ]
+
+        checker = Checker.__new__(Checker)
+        checker.name = name
+        checker.digest = None
+        checker.runcmds = [
+            RunCmd(args, Line(text, number, name))
+            for args, text, number in data["runcmds"]
         ]
+        checker.outchecks = checks(data["outchecks"], "CHECK")
+        checker.errchecks = checks(data["errchecks"], "CHECKERR")
+        checker.timeout = data["timeout"]
+        checker.maxtime = data["maxtime"]
+        checker.maxcpu = data["maxcpu"]
+        checker.maxrss = data["maxrss"]
+        return checker
+
+
+def source_digest():
+    """ Return a hash of littlecheck's own source, to tell apart versions. """
+    global _source_digest
+    if _source_digest is None:
+        import hashlib
+
+        digest = hashlib.sha256()
+        try:
+            with io.open(__file__, "rb") as fd:
+                digest.update(fd.read())
+        except (IOError, OSError, NameError):
+            pass
+        _source_digest = digest.hexdigest()
+    return _source_digest
+
+
+_source_digest = None
+
+
+class CheckerCache(object):
+    """ An on-disk cache of parsed Checkers.
+
+    Entries are keyed by a hash of the test file's contents and of
+    littlecheck's own source, so a changed file or a new littlecheck never
+    sees a stale entry. The cache is best-effort: entries that can't be read
+    or written are parsed again.
+
+    Attributes:
+        directory: where the entries are stored.
+        max_size: the total size in bytes that prune() shrinks the cache to.
+        max_age: the age in seconds after which prune() removes an entry.
+    """
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024, max_age=30 * 86400):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+
+    @staticmethod
+    def default_directory():
+        """ Return the default cache directory, following the XDG spec. """
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+        return os.path.join(base, "littlecheck")
 
+    def key(self, data):
+        """ Return the cache key for a file with the given bytes. """
+        import hashlib
 
-def check_file(input_file, name, subs, config, failure_handler):
+        digest = hashlib.sha256(source_digest().encode("ascii"))
+        digest.update(data)
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, key, name):
+        """ Return the cached Checker for key, named name, or None. """
+        import json
+
+        path = self.entry_path(key)
+        try:
+            with io.open(path, encoding="utf-8") as fd:
+                checker = Checker.from_dict(name, json.load(fd))
+            # Refresh the entry's age, so prune() removes the least recently used.
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError, TypeError, re.error):
+            return None
+        return checker
+
+    def store(self, key, checker):
+        """ Store checker under key. """
+        import json
+
+        try:
+            write_file(self.entry_path(key), json.dumps(checker.to_dict()))
+        except (IOError, OSError):
+            pass
+
+    def prune(self):
+        """ Remove entries older than max_age, then the least recently used
+            ones until the cache is no larger than max_size, and the
+            <key>.lock files of entries that are gone.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        entries = []
+        locks = [name for name in names if name.endswith(".lock")]
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort(reverse=True)
+        cutoff = time.time() - self.max_age
+        total = 0
+        for mtime, size, path in entries:
+            total += size
+            if mtime < cutoff or total > self.max_size:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        for name in locks:
+            path = os.path.join(self.directory, name)
+            if not os.path.exists(path[: -len(".lock")] + ".json"):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+
+class MemoryCheckerCache(object):
+    """ Keeps parsed Checkers in memory, for a long-running process like
+        the --serve server. It has the interface of CheckerCache, and holds up
+        to max_entries Checkers, dropping the least recently used.
+    """
+
+    def __init__(self, max_entries=1024):
+        import threading
+
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(data):
+        import hashlib
+
+        return hashlib.sha256(data).hexdigest()
+
+    def load(self, key, name):
+        """ Return the cached Checker for key, named name, or None. """
+        with self.lock:
+            checker = self.entries.get(key)
+            # The Lines of a Checker know the name of their file, so the same
+            # contents under another name have to be parsed again.
+            if checker is None or checker.name != name:
+                return None
+            self.entries.move_to_end(key)
+            return checker
+
+    def store(self, key, checker):
+        with self.lock:
+            self.entries[key] = checker
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def prune(self):
+        pass
+
+
+def check_file(input_file, name, subs, config, failure_handler, run_handler=None):
     """ Check a single file. Return a True on success, False on error. """
+    checker = Checker.from_text(name, input_file.read())
+    return check_checker(checker, subs, config, failure_handler, run_handler)
+
+
+def check_checker(checker, subs, config, failure_handler, run_handler=None):
+    """ Run the commands of a parsed file. Return a True on success, False on error.
+        If given, run_handler is called with each TestRun once it is done.
+    """
     success = True
-    lines = Line.readfile(input_file, name)
-    checker = Checker(name, lines)
-    for runcmd in checker.runcmds:
-        failure = TestRun(name, runcmd, checker, subs, config).run()
+    name = checker.name
+    testruns = [
+        TestRun(name, runcmd, checker, subs, config) for runcmd in checker.runcmds
+    ]
+    state = config.incremental
+    cancel = config.cancel
+    benchmark = config.repeat > 1 or config.warmup > 0
+    if benchmark:
+        # Passing before is no reason to skip measuring now.
+        state = None
+
+    def run(testrun):
+        if cancel and cancel.is_set():
+            testrun.cancelled = True
+            return None
+        if state and state.is_fresh(testrun):
+            testrun.cached = True
+            return None
+        starttime = time.monotonic()
+        failure = testrun.benchmark() if benchmark else testrun.run()
+        testrun.duration = time.monotonic() - starttime
+        if state and not testrun.cancelled:
+            state.record(testrun, failure is None)
+        if failure and cancel:
+            cancel.failed(name)
+        return failure
+
+    # Failures are handled in RUN-line order, even if the runs are concurrent.
+    for testrun, failure in zip(testruns, run_jobs(run, testruns, config.run_jobs)):
+        testrun.failure = failure
         if failure:
             failure_handler(failure)
             success = False
+        if run_handler:
+            run_handler(testrun)
     return success
 
 
-def check_path(path, subs, config, failure_handler):
-    with io.open(path, encoding="utf-8") as fd:
-        return check_file(fd, path, subs, config, failure_handler)
+def check_path(path, subs, config, failure_handler, run_handler=None, profile=None):
+    checker = load_checker(path, config.cache, profile, config.cwd)
+    return check_checker(checker, subs, config, failure_handler, run_handler)
+
+
+def load_checker(path, cache=None, profile=None, cwd=None):
+    """ Return the Checker for the file at path, with its digest set.
+        If a CheckerCache is given, take the Checker from it if possible,
+        and store it there otherwise. If a Profile is given, record the time
+        spent reading and parsing in it. A relative path is taken relative to
+        cwd, if given.
+    """
+    import hashlib
+
+    with io.open(os.path.join(cwd or "", path), "rb") as fd:
+        data = fd.read()
+    if profile:
+        profile.lap("read")
+    checker = None
+    if cache:
+        key = cache.key(data)
+        checker = cache.load(key, path)
+    if checker is None:
+        # Decode like io.open does, including the newline translation.
+        text = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8").read()
+        checker = Checker.from_text(path, text)
+        if cache:
+            cache.store(key, checker)
+    checker.digest = hashlib.sha256(data).hexdigest()
+    if profile:
+        profile.lap("parse")
+    return checker
+
+
+# Characters that make a command need a shell: pipes, redirections, separators,
+# expansions, globs and escapes.
+SHELL_CHARS = frozenset("|&;<>()$`\\*?[]{}~#!\n")
+
+# Shell keywords and builtins, which only a shell runs the way it would, even
+# where there is an executable of the same name.
+SHELL_WORDS = frozenset(
+    """
+    . : [ alias bg break case cd command continue declare do done echo elif
+    else esac eval exec exit export false fc fg fi for function getopts hash
+    if jobs kill let local printf pwd read readonly return select set shift
+    source test then time times trap true type typeset ulimit umask unalias
+    unset until wait while
+    """.split()
+)
+
+
+def direct_argv(command):
+    """ Return the arguments to run a shell command with, if it can be run
+        without a shell with the same effect, or None if it needs one.
+    """
+    if any(c in SHELL_CHARS for c in command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    # A leading VAR=value is an assignment, not the command.
+    if not argv or argv[0] in SHELL_WORDS or "=" in argv[0]:
+        return None
+    return argv
+
+
+def command_dependencies(command):
+    """ Return the paths of the files a shell command refers to: the
+        executables it runs, and the arguments that name existing files.
+    """
+    import shutil
+
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        tokens = list(lexer)
+    except ValueError:
+        tokens = command.split()
+    paths = []
+    command_position = True
+    output_file = False
+    for token in tokens:
+        if token and all(c in "();<>|&" for c in token):
+            # After a pipe or separator comes another command,
+            # after a redirection a file.
+            command_position = "<" not in token and ">" not in token
+            output_file = ">" in token
+        elif output_file:
+            # The command writes this file, so it is not an input.
+            output_file = False
+        elif command_position:
+            if "=" not in token:
+                # Not a variable assignment, so this is the command itself.
+                path = shutil.which(token)
+                if path:
+                    paths.append(path)
+                command_position = False
+        elif os.path.isfile(token):
+            paths.append(token)
+    return paths
+
+
+class IncrementalState(object):
+    """ Remembers the RUN lines that passed, and with which inputs, so that
+        --incremental can skip them if nothing changed.
+
+    The inputs of a RUN line are fingerprinted by the contents of its file,
+    the substituted command, its timeout, littlecheck's own source, and the
+    mtime and size of the files the command refers to.
+    Files that are read by the command without being named are not noticed.
+
+    Attributes:
+        path: the JSON file the state is loaded from and saved to.
+        passed: maps "file:line" of each passing RUN line to its fingerprint.
+    """
+
+    def __init__(self, path):
+        import json
+        import threading
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.passed = {}
+        try:
+            with io.open(path, encoding="utf-8") as fd:
+                self.passed = dict(json.load(fd))
+        except (IOError, OSError, ValueError, TypeError):
+            pass
+
+    @staticmethod
+    def key(testrun):
+        return "%s:%d" % (os.path.abspath(testrun.name), testrun.runcmd.line.number)
+
+    @staticmethod
+    def fingerprint(testrun):
+        """ Return the fingerprint of the inputs of testrun, or None if unknown. """
+        import hashlib
+        import json
+
+        if testrun.checker.digest is None:
+            return None
+        deps = []
+        for path in command_dependencies(testrun.subbed_command):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            deps.append([os.path.abspath(path), st.st_mtime_ns, st.st_size])
+        inputs = [
+            source_digest(),
+            testrun.checker.digest,
+            os.getcwd(),
+            testrun.subbed_command,
+            testrun.timeout,
+            deps,
+        ]
+        return hashlib.sha256(json.dumps(inputs).encode("utf-8")).hexdigest()
+
+    def is_fresh(self, testrun):
+        """ Return whether testrun passed before with the same inputs.
+            Remember its fingerprint for record().
+        """
+        testrun.fingerprint = self.fingerprint(testrun)
+        with self.lock:
+            passed = self.passed.get(self.key(testrun))
+        return passed is not None and passed == testrun.fingerprint
+
+    def record(self, testrun, passed):
+        """ Record the result of testrun, after is_fresh. """
+        with self.lock:
+            if passed and testrun.fingerprint:
+                self.passed[self.key(testrun)] = testrun.fingerprint
+            else:
+                self.passed.pop(self.key(testrun), None)
+
+    def save(self):
+        import json
+
+        with self.lock:
+            data = json.dumps(self.passed, indent=0, sort_keys=True)
+        write_file(self.path, data)
+
+
+class TimingHistory(object):
+    """ A small database of how checking each file went in earlier runs,
+        stored as JSON, to balance shards and schedule the files.
+
+    Attributes:
+        path: the JSON file the history is loaded from and saved to.
+        files: maps each file path to a dictionary with its "duration" in
+            seconds, whether it "passed", and if it ever failed, the time of
+            the last failure as "failed_at".
+    """
+
+    def __init__(self, path):
+        import json
+
+        self.path = path
+        self.files = {}
+        try:
+            with io.open(path, encoding="utf-8") as fd:
+                self.files = dict(json.load(fd)["files"])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    @staticmethod
+    def key(path):
+        return os.path.normpath(path)
+
+    def entry(self, path):
+        entry = self.files.get(self.key(path))
+        return entry if isinstance(entry, dict) else {}
+
+    def duration(self, path):
+        """ Return the recorded duration of checking path in seconds, or None. """
+        return self.entry(path).get("duration")
+
+    def durations(self, paths):
+        """ Return the recorded durations of paths. Those without one get the
+            average of the others, or 1 if there are none.
+        """
+        durations = [self.duration(path) for path in paths]
+        known = [d for d in durations if d is not None]
+        default = sum(known) / len(known) if known else 1.0
+        return [default if d is None else d for d in durations]
+
+    def last_failure(self, path):
+        """ Return when path failed, if it failed the last time it was checked. """
+        entry = self.entry(path)
+        return entry.get("failed_at") if entry.get("passed") is False else None
+
+    def record(self, path, duration, passed=True):
+        """ Record that checking path took duration seconds, and whether it passed. """
+        entry = self.files.setdefault(self.key(path), {})
+        entry["duration"] = duration
+        entry["passed"] = passed
+        if not passed:
+            entry["failed_at"] = time.time()
+
+    def save(self):
+        import json
+
+        data = json.dumps({"files": self.files}, indent=0, sort_keys=True)
+        write_file(self.path, data)
+
+
+def write_file(path, text):
+    """ Replace the file at path with text, creating its directory if needed.
+        The text is written to a temporary file first, so concurrent readers
+        never see a partial file.
+    """
+    import tempfile
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmppath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with io.open(fd, "w", encoding="utf-8") as tmp:
+            tmp.write(text)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def shard_files(paths, index, count, history=None):
+    """ Return the paths that belong to shard index (counting from 1) out of
+        count, in their original order.
+
+    Without a TimingHistory, paths are dealt out round-robin. With one, each
+    path, longest first, goes to the shard with the least total duration so
+    far, so that the shards take about the same time. Paths without a
+    recorded duration count as the average. The result only depends on the
+    arguments, so every shard computes the same partition.
+    """
+    if history is None:
+        return [path for i, path in enumerate(paths) if i % count == index - 1]
+    durations = history.durations(paths)
+    loads = [0.0] * count
+    mine = []
+    for i in sorted(range(len(paths)), key=lambda i: (-durations[i], i)):
+        shard = loads.index(min(loads))
+        loads[shard] += durations[i]
+        if shard == index - 1:
+            mine.append(i)
+    return [paths[i] for i in sorted(mine)]
+
+
+def schedule_files(paths, history):
+    """ Return paths in the order to check them, given a TimingHistory.
+
+    Files that failed the last time come first, the most recent failure
+    first, so regressions show up early. The rest follow longest first, so
+    no long file starts last and holds up the end of a parallel run.
+    Paths without a recorded duration count as the average. Ties keep their
+    original order.
+    """
+    durations = history.durations(paths)
+
+    def key(i):
+        failed_at = history.last_failure(paths[i])
+        return (failed_at is None, -(failed_at or 0), -durations[i], i)
+
+    return [paths[i] for i in sorted(range(len(paths)), key=key)]
+
+
+def parse_shard(shard):
+    """ Given a shard like '2/4', return a tuple like (2, 4), or exit if invalid. """
+    try:
+        index, count = [int(n) for n in shard.split("/")]
+    except ValueError:
+        print("Invalid shard %s: expected INDEX/COUNT" % shard)
+        sys.exit(1)
+    if not 1 <= index <= count:
+        print("Invalid shard %s: index must be between 1 and the count" % shard)
+        sys.exit(1)
+    return index, count
+
+
+class Profile(object):
+    """ Where the time went when checking a file or running a RUN line.
+
+    Attributes:
+        phases: maps each phase to the seconds spent in it. For files they
+            are "read", "parse" and "format" (of the failure messages), for
+            RUN lines "substitute", "spawn", "wait" (for the command to exit,
+            including reading its output), "decode" and "match".
+        usage: for RUN lines, a dictionary with the "user" and "system" CPU
+            seconds of the command and its children, and their maximum
+            resident set size as "maxrss" in KiB; or None if unknown.
+    """
+
+    __slots__ = ("phases", "usage", "last")
+
+    def __init__(self):
+        self.phases = {}
+        self.usage = None
+        self.start()
+
+    def start(self):
+        """ Start timing the next phase from now. """
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        """ Add the time since the end of the last phase to phase. """
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+
+class FileResult(object):
+    """ The outcome of checking a single file.
+
+    Attributes:
+        path: the path of the checked file.
+        success: whether all RUN lines passed.
+        failures: list of TestFailures, in RUN-line order.
+        runs: list of finished TestRuns, in RUN-line order.
+        duration: wall time spent checking the file, in seconds.
+        profile: a Profile of the file if config.profile is set, or None.
+        cancelled: whether some RUN lines were skipped or stopped because
+            of too many failures.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.success = True
+        self.failures = []
+        self.runs = []
+        self.duration = None
+        self.profile = None
+        self.cancelled = False
+
+    def cached(self):
+        """ Return whether all RUN lines were skipped by --incremental. """
+        return bool(self.runs) and all(run.cached for run in self.runs)
+
+
+def check_one(path, subs, config):
+    """ Check the file at path, collecting failures instead of printing them.
+        The %s substitution is added to a copy of subs. Return a FileResult.
+    """
+    result = FileResult(path)
+    subs = subs.copy()
+    subs["s"] = path
+    if config.profile:
+        result.profile = Profile()
+    starttime = time.monotonic()
+    if config.cancel and config.cancel.is_set():
+        result.cancelled = True
+    else:
+        result.success = check_path(
+            path,
+            subs,
+            config,
+            result.failures.append,
+            result.runs.append,
+            result.profile,
+        )
+        result.cancelled = any(testrun.cancelled for testrun in result.runs)
+    result.duration = time.monotonic() - starttime
+    return result
+
+
+class Cancellation(object):
+    """ Stops checking once max_failures files have failed: RUN lines that
+        have not started are skipped, and the commands of those that are
+        running are killed.
+    """
+
+    def __init__(self, max_failures):
+        import threading
+
+        self.max_failures = max_failures
+        self.failures = set()
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        # The running TestRuns and their Popens.
+        self.running = {}
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def failed(self, name):
+        """ Record that the file name failed, and cancel if that is too many. """
+        with self.lock:
+            self.failures.add(name)
+            if len(self.failures) < self.max_failures:
+                return
+        self.cancel()
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            for testrun, proc in self.running.items():
+                testrun.cancelled = True
+                testrun.kill(proc)
+
+    def start(self, testrun, proc):
+        """ Record that testrun is running proc, or kill it if cancelled. """
+        with self.lock:
+            if self.event.is_set():
+                testrun.cancelled = True
+                testrun.kill(proc)
+            self.running[testrun] = proc
+
+    def finish(self, testrun):
+        """ Record that the command of testrun has exited. """
+        with self.lock:
+            self.running.pop(testrun, None)
+
+
+def run_jobs(func, items, jobs):
+    """ Call func on each of items, using up to jobs worker threads.
+        Yield the results in the order of items. Each result is yielded as soon
+        as it and all of its predecessors are available, so callers can report
+        in a deterministic order while later items are still running.
+        With a single job, func is only called when the next result is requested.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(func, item) for item in items]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # If the caller stops early, don't start the rest.
+            for future in futures:
+                future.cancel()
+
+
+PROFILE_PHASES = (
+    "read",
+    "parse",
+    "substitute",
+    "spawn",
+    "wait",
+    "decode",
+    "match",
+    "format",
+)
+
+
+def profile_report(results):
+    """ Return the profiles of a list of FileResults as a JSON-compatible dict. """
+    files = []
+    totals = dict.fromkeys(PROFILE_PHASES, 0.0)
+    for result in results:
+        runs = []
+        for testrun in result.runs:
+            if testrun.cached:
+                continue
+            runs.append(
+                {
+                    "line": testrun.runcmd.line.number,
+                    "command": testrun.subbed_command,
+                    "phases": testrun.profile.phases,
+                    "usage": testrun.profile.usage,
+                }
+            )
+        for phases in [result.profile.phases] + [run["phases"] for run in runs]:
+            for phase, seconds in phases.items():
+                totals[phase] += seconds
+        phases = result.profile.phases
+        files.append({"path": result.path, "phases": phases, "runs": runs})
+    return {"files": files, "totals": totals}
+
+
+def percentile(values, fraction):
+    """ Return the nearest-rank percentile of a sorted list. """
+    import math
+
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summarize(values):
+    """ Return the min, median, 95th percentile and max of values in a dict. """
+    values = sorted(values)
+    return {
+        "min": values[0],
+        "median": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "max": values[-1],
+    }
+
+
+def stats_report(results):
+    """ Return the statistics of the repeated runs in a list of FileResults
+        as a JSON-compatible list, with an entry for each RUN line.
+    """
+    report = []
+    for result in results:
+        for testrun in result.runs:
+            if not testrun.samples:
+                continue
+            cpus = [cpu for wall, cpu in testrun.samples]
+            report.append(
+                {
+                    "file": result.path,
+                    "lineno": testrun.runcmd.line.number,
+                    "command": testrun.subbed_command,
+                    "runs": len(testrun.samples),
+                    "wall": summarize([wall for wall, cpu in testrun.samples]),
+                    "cpu": None if None in cpus else summarize(cpus),
+                }
+            )
+    return report
+
+
+def print_stats(report):
+    """ Print a stats_report as a table, in milliseconds. """
+    stats = ("min", "median", "p95", "max")
+    header = "{:<32}{:>6}".format("RUN line (ms)", "runs")
+    header += "".join("{:>12}".format("wall " + stat) for stat in stats)
+    header += "".join("{:>12}".format("cpu " + stat) for stat in stats)
+    print(header)
+    for entry in report:
+        name = "{}:{}".format(entry["file"], entry["lineno"])
+        text = "{:<32}{:>6}".format(
+            name if len(name) <= 31 else "..." + name[-28:], entry["runs"]
+        )
+        for kind in ("wall", "cpu"):
+            for stat in stats:
+                value = entry[kind][stat] * 1000 if entry[kind] else None
+                text += "{:>12}".format("-" if value is None else "%.2f" % value)
+        print(text)
+
+
+def print_profile(report):
+    """ Print a profile_report as a table. """
+    header = "{:<32}".format("profile (seconds)")
+    header += "".join("{:>11}".format(phase) for phase in PROFILE_PHASES)
+    header += "{:>9}{:>9}{:>11}".format("user", "system", "maxrss")
+    print(header)
+
+    def row(name, phases, usage=None):
+        text = "{:<32}".format(name if len(name) <= 31 else "..." + name[-28:])
+        for phase in PROFILE_PHASES:
+            seconds = phases.get(phase)
+            text += "{:>11}".format("-" if seconds is None else "%.4f" % seconds)
+        if usage:
+            text += "{user:>9.3f}{system:>9.3f}{maxrss:>10}K".format(**usage)
+        print(text)
+
+    for entry in report["files"]:
+        row(entry["path"], entry["phases"])
+        for run in entry["runs"]:
+            row("  RUN line {}".format(run["line"]), run["phases"], run["usage"])
+    row("total", report["totals"])
+
+
+def run_status(testrun):
+    """ Return "pass", "fail", "cached" or "skipped" for a finished TestRun. """
+    if testrun.cancelled:
+        return "skipped"
+    if testrun.cached:
+        return "cached"
+    return "fail" if testrun.failure else "pass"
+
+
+def file_status(result):
+    """ Return "pass", "fail" or "skipped" for a FileResult. """
+    if not result.success:
+        return "fail"
+    return "skipped" if result.cancelled else "pass"
+
+
+class JsonLinesReport(object):
+    """ Writes a JSON object per line to a file as the results come in:
+        one per RUN line with its status, duration and failure details,
+        followed by one for the file as a whole.
+    """
+
+    def __init__(self, path):
+        self.fd = io.open(path, "w", encoding="utf-8")
+
+    def add(self, result):
+        """ Write the records for a FileResult. """
+        import json
+
+        for testrun in result.runs:
+            record = {
+                "event": "run",
+                "file": result.path,
+                "lineno": testrun.runcmd.line.number,
+                "command": testrun.subbed_command,
+                "status": run_status(testrun),
+                "duration": testrun.duration,
+                "failure": testrun.failure.to_dict() if testrun.failure else None,
+            }
+            self.fd.write(json.dumps(record) + "\n")
+        record = {
+            "event": "file",
+            "file": result.path,
+            "status": file_status(result),
+            "cached": result.cached(),
+            "duration": result.duration,
+            "runs": len(result.runs),
+            "failures": len(result.failures),
+        }
+        self.fd.write(json.dumps(record) + "\n")
+        self.fd.flush()
+
+    def close(self):
+        self.fd.close()
+
+
+class JUnitReport(object):
+    """ Writes JUnit XML to a file as the results come in: a testsuite per
+        file, with a testcase per RUN line. The file is only complete, with
+        its closing tag, once closed.
+    """
+
+    ANSI_RE = re.compile(r"\x1b\[[0-9;]*m")
+    # Characters XML 1.0 does not allow, even escaped.
+    INVALID_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+    def __init__(self, path):
+        self.fd = io.open(path, "w", encoding="utf-8")
+        self.fd.write('<?xml version="1.0" encoding="UTF-8"?>\n<testsuites>\n')
+        self.fd.flush()
+
+    def text(self, text):
+        """ Return text without colors, and with the characters XML can't
+            represent escaped like in failure messages.
+        """
+        text = self.ANSI_RE.sub("", text)
+        return self.INVALID_RE.sub(lambda m: "\\x{:02x}".format(ord(m.group())), text)
+
+    def add(self, result):
+        """ Write the testsuite for a FileResult. """
+        from xml.sax.saxutils import escape, quoteattr
+
+        def attr(value):
+            return quoteattr(self.text(value))
+
+        skipped = sum(1 for run in result.runs if run.cancelled or run.cached)
+        self.fd.write(
+            "  <testsuite name={} tests={} failures={} skipped={} time={}>\n".format(
+                attr(result.path),
+                quoteattr(str(len(result.runs))),
+                quoteattr(str(len(result.failures))),
+                quoteattr(str(skipped)),
+                quoteattr("%.3f" % result.duration),
+            )
+        )
+        for testrun in result.runs:
+            self.fd.write(
+                "    <testcase classname={} name={} time={}>\n".format(
+                    attr(result.path),
+                    attr(
+                        "RUN line {}: {}".format(
+                            testrun.runcmd.line.number, testrun.subbed_command
+                        )
+                    ),
+                    quoteattr("%.3f" % (testrun.duration or 0)),
+                )
+            )
+            if testrun.cancelled:
+                self.fd.write('      <skipped message="too many failures"/>\n')
+            elif testrun.cached:
+                self.fd.write('      <skipped message="cached"/>\n')
+            elif testrun.failure:
+                text = self.text(testrun.failure.message())
+                self.fd.write(
+                    "      <failure type={}>{}</failure>\n".format(
+                        quoteattr(testrun.failure.kind()), escape(text)
+                    )
+                )
+            self.fd.write("    </testcase>\n")
+        self.fd.write("  </testsuite>\n")
+        self.fd.flush()
+
+    def close(self):
+        self.fd.write("</testsuites>\n")
+        self.fd.close()
+
+
+def file_signature(path):
+    """ Return something that changes when the file at path is modified,
+        replaced, created or removed.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class Inotify(object):
+    """ Wakes up when something changes in a set of directories, with the
+        Linux inotify API through ctypes.
+    """
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    # | IN_CREATE | IN_DELETE
+    MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        # IN_NONBLOCK and IN_CLOEXEC are the same as for open().
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = set()
+
+    @staticmethod
+    def create():
+        """ Return an Inotify, or None if the system doesn't have it. """
+        try:
+            return Inotify()
+        except (OSError, AttributeError, TypeError):
+            return None
+
+    def watch(self, directory):
+        if directory in self.directories:
+            return
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK) >= 0:
+            self.directories.add(directory)
+
+    def wait(self, timeout):
+        """ Wait up to timeout seconds for changes, and consume their events. """
+        import select
+
+        select.select([self.fd], [], [], timeout)
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+
+class FileWatcher(object):
+    """ Waits for any of a set of files to change. With inotify, it wakes up
+        when something in their directories changes, otherwise it checks
+        every interval seconds. Either way, it compares file_signatures to
+        tell which of the files changed.
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.signatures = {}
+        self.inotify = Inotify.create()
+
+    def watch(self, paths):
+        """ Watch paths, as they are now, instead of the previous ones. """
+        self.signatures = dict((path, file_signature(path)) for path in paths)
+        if self.inotify:
+            for path in paths:
+                self.inotify.watch(os.path.dirname(path) or ".")
+
+    def wait(self):
+        """ Wait until some of the files change. Return their paths. """
+        while True:
+            if self.inotify:
+                # Directories that don't exist yet can't be watched,
+                # so look now and then anyway.
+                self.inotify.wait(max(self.interval, 5))
+            else:
+                time.sleep(self.interval)
+            changed = set(
+                path
+                for path, signature in self.signatures.items()
+                if file_signature(path) != signature
+            )
+            if changed:
+                return changed
+
+
+def watched_paths(path, result):
+    """ Return the absolute paths that the outcome of checking the file at
+        path depends on: the file, and what its commands refer to.
+    """
+    paths = set([os.path.abspath(path)])
+    for testrun in result.runs if result else []:
+        for dep in command_dependencies(testrun.subbed_command):
+            paths.add(os.path.abspath(dep))
+    return paths
+
+
+def watch(files, subs, config, jobs, watcher=None):
+    """ Check files, and check each of them again whenever it or a file its
+        commands refer to changes, until interrupted. Parsed files are kept
+        in memory. The files are compared to how they were after the last
+        check, so the commands may write to them without causing a loop.
+    """
+    config.cache = MemoryCheckerCache()
+    watcher = watcher or FileWatcher()
+    try:
+        watch_loop(files, subs, config, jobs, watcher)
+    except KeyboardInterrupt:
+        print()
+
+
+def watch_loop(files, subs, config, jobs, watcher):
+    fields = config.colors()
+    depends = {}
+    pending = list(files)
+    while True:
+        failure_count = 0
+        skipped = set()
+        if config.cancel:
+            # Each pass may have as many failures as the first.
+            config.cancel = Cancellation(config.cancel.max_failures)
+
+        def check(path):
+            try:
+                return check_one(path, subs, config), None
+            except (CheckerError, IOError, OSError) as e:
+                return None, e
+
+        for path, (result, error) in zip(pending, run_jobs(check, pending, jobs)):
+            fields["path"] = path
+            if error:
+                fields["error"] = error
+                print("{RED}Error{RESET} in {path}: {error}".format(**fields))
+            for failure in result.failures if result else []:
+                failure.print_message()
+            if error or not result.success:
+                failure_count += 1
+            elif result.cancelled:
+                skipped.add(path)
+                if config.progress:
+                    print("{YELLOW}skipped{RESET} {path}".format(**fields))
+            elif config.progress:
+                print("{GREEN}ok{RESET} {path}".format(**fields))
+            depends[path] = watched_paths(path, result)
+        fields["checked"] = len(pending) - len(skipped)
+        fields["failed"] = failure_count
+        fields["skipped"] = ", {} skipped".format(len(skipped)) if skipped else ""
+        print(
+            "Checked {checked} files, {failed} failed{skipped}. "
+            "Waiting for changes...".format(**fields)
+        )
+        sys.stdout.flush()
+        watcher.watch(set().union(*depends.values()))
+        changed = watcher.wait()
+        # Skipped files are checked with the next changes.
+        pending = [
+            path for path in files if depends[path] & changed or path in skipped
+        ]
+
+
+# The Config attributes a client of the server may set.
+SERVER_OPTIONS = (
+    "after",
+    "before",
+    "colorize",
+    "progress",
+    "fail_early",
+    "timeout",
+    "run_jobs",
+    "spill_threshold",
+    "direct_exec",
+)
+
+
+def serve_request(request, cache):
+    """ Check a file for a client of the server, and return the response.
+
+    The request is a dict with the "path" of the file, and optionally the
+    "cwd" to check it in, the "env" of the commands, the "subs" to make, and
+    "options" with values for the SERVER_OPTIONS. The response has the
+    "path", whether it was a "success", the "output" to print for it, the
+    "failures" as TestFailure.to_dict() and the "duration" in seconds; or
+    an "error" message if it could not be checked.
+    """
+    path = request.get("path")
+    config = Config()
+    config.cache = cache
+    config.cwd = request.get("cwd")
+    config.env = request.get("env")
+    for option, value in request.get("options", {}).items():
+        if option in SERVER_OPTIONS:
+            setattr(config, option, value)
+    subs = {"%": "%"}
+    subs.update(request.get("subs", {}))
+    try:
+        result = check_one(path, subs, config)
+    except (CheckerError, IOError, OSError, TypeError, ValueError) as e:
+        return {"path": path, "error": str(e)}
+    return {
+        "path": path,
+        "success": result.success,
+        "output": "".join(failure.message() + "\n" for failure in result.failures),
+        "failures": [failure.to_dict() for failure in result.failures],
+        "duration": result.duration,
+    }
+
+
+def make_server(address):
+    """ Return a server for check requests on a Unix socket at address.
+
+    Each request and response is a JSON object on a line of its own, see
+    serve_request. Requests on one connection are answered in order, and
+    connections are served concurrently. Parsed files are kept in memory
+    between requests.
+    """
+    import json
+    import socketserver
+    import stat
+
+    cache = MemoryCheckerCache()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                except ValueError as e:
+                    response = {"error": "Invalid request: " + str(e)}
+                else:
+                    response = serve_request(request, cache)
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
+
+    # Replace the socket of a server that is gone, but nothing else.
+    try:
+        if stat.S_ISSOCK(os.stat(address).st_mode):
+            os.unlink(address)
+    except OSError:
+        pass
+    server = socketserver.ThreadingUnixStreamServer(address, Handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(address):
+    """ Serve check requests on a Unix socket at address until interrupted
+        or terminated, and remove the socket then.
+    """
+    server = make_server(address)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(address)
+
+
+def request_checks(address, paths, subs, options):
+    """ Have the server at address check the files at paths, and print the
+        results like main does. Return the number of failed files.
+    """
+    import json
+    import socket
+
+    config = Config()
+    config.colorize = options.get("colorize", False)
+    fields = config.colors()
+    failure_count = 0
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    with sock, sock.makefile("rwb") as stream:
+        for path in paths:
+            request = {
+                "path": path,
+                "cwd": os.getcwd(),
+                "env": dict(os.environ),
+                "subs": subs,
+                "options": options,
+            }
+            fields["path"] = path
+            if options.get("progress"):
+                print("Testing file {path} ... ".format(**fields), end="")
+                sys.stdout.flush()
+            stream.write(json.dumps(request).encode("utf-8") + b"\n")
+            stream.flush()
+            line = stream.readline()
+            if not line:
+                raise IOError("The server closed the connection")
+            response = json.loads(line.decode("utf-8"))
+            if "error" in response:
+                fields["error"] = response["error"]
+                print("{RED}Error{RESET} in {path}: {error}".format(**fields))
+                failure_count += 1
+                continue
+            sys.stdout.write(response["output"])
+            if not response["success"]:
+                failure_count += 1
+            elif options.get("progress"):
+                duration_ms = round(response["duration"] * 1000)
+                print(
+                    "{GREEN}ok{RESET} ({duration} ms)".format(
+                        duration=duration_ms, **fields
+                    )
+                )
+    return failure_count
 
 
 def parse_subs(subs):
@@ -482,6 +2782,8 @@ def parse_subs(subs):
 
 def get_argparse():
     """ Return a littlecheck argument parser. """
+    import argparse
+
     parser = argparse.ArgumentParser(
         description="littlecheck: command line tool tester."
     )
@@ -501,7 +2803,7 @@ def get_argparse():
         help="Show the files to be checked",
         default=False,
     )
-    parser.add_argument("file", nargs="+", help="File to check")
+    parser.add_argument("file", nargs="*", help="File to check")
     parser.add_argument(
         "-A",
         "--after",
@@ -518,11 +2820,269 @@ def get_argparse():
         action="store",
         default=5,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="How many files to check in parallel (default: 1, 0 means one per CPU)",
+        action="store",
+        default=1,
+    )
+    parser.add_argument(
+        "--run-jobs",
+        type=int,
+        help="How many RUN lines of a file to run in parallel (default: 1, 0 means one per CPU)",
+        action="store",
+        default=1,
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Kill commands that run for longer than this many seconds",
+        action="store",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Cache parsed test files in " + CheckerCache.default_directory(),
+        default=False,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Cache parsed test files in this directory",
+        action="store",
+        default=None,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip RUN lines that passed before, unless the file, the command "
+        "or the files it refers to changed",
+        default=False,
+    )
+    parser.add_argument(
+        "--spill-dir",
+        type=str,
+        help="Have commands write their output to files in this directory, "
+        "instead of keeping it in memory",
+        action="store",
+        default=None,
+    )
+    parser.add_argument(
+        "--spill-threshold",
+        type=int,
+        help="Move output larger than this many bytes from memory to a file "
+        "(default: 64 MiB)",
+        action="store",
+        default=64 * 1024 * 1024,
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help="Only check shard INDEX (from 1) of COUNT equal parts of the files, "
+        "balanced by duration with --timings",
+        action="store",
+        default=None,
+    )
+    parser.add_argument(
+        "--timings",
+        type=str,
+        help="JSON file with the durations and outcomes of earlier runs, "
+        "updated after this one",
+        action="store",
+        default=None,
+    )
+    parser.add_argument(
+        "--schedule",
+        action="store_true",
+        help="Check the files that failed last time first, then the longest ones, "
+        "according to --timings (default: timings.json in the cache directory)",
+        default=False,
+    )
+    parser.add_argument(
+        "--fail-early",
+        action="store_true",
+        help="Check output while it is produced, and stop a command at its first failure",
+        default=False,
+    )
+    parser.add_argument(
+        "--report-jsonl",
+        help="Write a JSON record for each RUN line and file to this file, "
+        "as they finish",
+        action="store",
+        default=None,
+    )
+    parser.add_argument(
+        "--junit-xml",
+        help="Write the results to this file as JUnit XML, as they finish",
+        action="store",
+        default=None,
+    )
+    parser.add_argument(
+        "--shell",
+        action="store_true",
+        help="Run every command through /bin/sh, even if it needs no shell",
+        default=False,
+    )
+    parser.add_argument(
+        "--max-failures",
+        type=int,
+        metavar="N",
+        help="Stop after N files failed, skipping the rest and killing running "
+        "commands",
+        default=None,
+    )
+    parser.add_argument(
+        "-x",
+        "--exitfirst",
+        dest="max_failures",
+        action="store_const",
+        const=1,
+        help="Stop after the first failed file, like --max-failures 1",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        metavar="N",
+        help="Run each command N times and print statistics of its wall and CPU time",
+        default=1,
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        metavar="K",
+        help="Run each command K more times before --repeat, without measuring it",
+        default=0,
+    )
+    parser.add_argument(
+        "--check-first",
+        action="store_true",
+        help="With --repeat, only check the output of the first run",
+        default=False,
+    )
+    parser.add_argument(
+        "--stats-json",
+        help="Write the statistics of --repeat to this JSON file",
+        action="store",
+        default=None,
+    )
+    parser.add_argument(
+        "--persistent-shell",
+        action="store_true",
+        help="Run the commands in long-running shells, one per concurrent "
+        "command. This is ignored for commands with a timeout, MAXCPU or "
+        "MAXRSS, and for all commands with --fail-early, --max-failures/-x, "
+        "--profile, --repeat or --warmup",
+        default=False,
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running, and check files again when they or the files their "
+        "commands refer to change",
+        default=False,
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="SOCKET",
+        help="Run a server on this Unix socket that checks files for --connect",
+        action="store",
+        default=None,
+    )
+    parser.add_argument(
+        "--connect",
+        metavar="SOCKET",
+        help="Have the server on this Unix socket check the files",
+        action="store",
+        default=None,
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print where the time goes for each file and RUN line",
+        default=False,
+    )
+    parser.add_argument(
+        "--profile-json",
+        help="Write the profile of each file and RUN line to this JSON file",
+        action="store",
+        default=None,
+    )
     return parser
 
 
+# The options that --connect doesn't apply, by their argparse dest. Only the
+# SERVER_OPTIONS are sent to the server, and the client checks the files one
+# after the other, without reports.
+CONNECT_UNSUPPORTED = (
+    "jobs",
+    "cache",
+    "cache_dir",
+    "incremental",
+    "spill_dir",
+    "shard",
+    "timings",
+    "schedule",
+    "report_jsonl",
+    "junit_xml",
+    "max_failures",
+    "repeat",
+    "warmup",
+    "check_first",
+    "stats_json",
+    "persistent_shell",
+    "watch",
+    "profile",
+    "profile_json",
+)
+
+
+# The options that --watch doesn't apply, by their argparse dest. It only prints
+# the results, and keeps parsed files in memory.
+WATCH_UNSUPPORTED = (
+    "cache",
+    "cache_dir",
+    "incremental",
+    "shard",
+    "timings",
+    "schedule",
+    "report_jsonl",
+    "junit_xml",
+    "repeat",
+    "warmup",
+    "check_first",
+    "stats_json",
+    "profile",
+    "profile_json",
+)
+
+
+def check_mode_options(parser, args, mode, unsupported):
+    """ Exit with an error if args combine the option mode, like "--connect",
+        with one of the unsupported dests.
+    """
+    for dest in unsupported:
+        if getattr(args, dest) != parser.get_default(dest):
+            option = {"max_failures": "--max-failures/-x", "jobs": "-j/--jobs"}.get(
+                dest, "--" + dest.replace("_", "-")
+            )
+            parser.error("{} can't be used with {}".format(mode, option))
+
+
 def main():
-    args = get_argparse().parse_args()
+    parser = get_argparse()
+    args = parser.parse_args()
+    if args.connect:
+        check_mode_options(parser, args, "--connect", CONNECT_UNSUPPORTED)
+    if args.watch:
+        check_mode_options(parser, args, "--watch", WATCH_UNSUPPORTED)
+    if args.serve:
+        serve(args.serve)
+        return
+    if not args.file:
+        parser.error("the following arguments are required: file")
     # Default substitution is %% -> %
     def_subs = {"%": "%"}
     def_subs.update(parse_subs(args.substitute))
@@ -531,6 +3091,34 @@ def main():
     config = Config()
     config.colorize = sys.stdout.isatty()
     config.progress = args.progress
+    config.fail_early = args.fail_early
+    config.direct_exec = not args.shell
+    config.repeat = args.repeat
+    config.warmup = args.warmup
+    config.check_first = args.check_first
+    if config.repeat < 1:
+        raise ValueError("Repeat must be at least 1")
+    if config.warmup < 0:
+        raise ValueError("Warmup must be at least 0")
+    if args.max_failures is not None:
+        if args.max_failures < 1:
+            raise ValueError("Max failures must be at least 1")
+        config.cancel = Cancellation(args.max_failures)
+    if args.persistent_shell:
+        config.shells = ShellSessions()
+    config.profile = args.profile or bool(args.profile_json)
+    config.timeout = args.timeout
+    config.spill_dir = args.spill_dir
+    config.spill_threshold = args.spill_threshold
+    if config.timeout is not None and config.timeout <= 0:
+        raise ValueError("Timeout must be greater than 0")
+    cache_dir = args.cache_dir or CheckerCache.default_directory()
+    if args.cache_dir or args.cache:
+        config.cache = CheckerCache(cache_dir)
+    if args.incremental:
+        config.incremental = IncrementalState(
+            os.path.join(cache_dir, "incremental.json")
+        )
     fields = config.colors()
     config.after = args.after
     config.before = args.before
@@ -539,24 +3127,116 @@ def main():
     if config.after < 0:
         raise ValueError("After must be at least 0")
 
-    for path in args.file:
+    jobs = args.jobs
+    if jobs < 0:
+        raise ValueError("Jobs must be at least 0")
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    config.run_jobs = args.run_jobs
+    if config.run_jobs < 0:
+        raise ValueError("Run jobs must be at least 0")
+    if config.run_jobs == 0:
+        config.run_jobs = os.cpu_count() or 1
+
+    if args.watch:
+        watch(args.file, def_subs, config, jobs)
+        if config.shells:
+            config.shells.close()
+        return
+
+    if args.connect:
+        options = {option: getattr(config, option) for option in SERVER_OPTIONS}
+        sys.exit(request_checks(args.connect, args.file, def_subs, options))
+
+    files = args.file
+    history = None
+    if args.timings or args.schedule:
+        timings = args.timings or os.path.join(cache_dir, "timings.json")
+        history = TimingHistory(timings)
+    if args.shard:
+        index, count = parse_shard(args.shard)
+        files = shard_files(files, index, count, history)
+    if args.schedule:
+        files = schedule_files(files, history)
+
+    # Files are checked by the workers, but only reported from here, in the
+    # order they are scheduled in, so their output never interleaves.
+    results = run_jobs(lambda path: check_one(path, def_subs, config), files, jobs)
+    profiled = []
+    benchmark = config.repeat > 1 or config.warmup > 0
+    benchmarked = []
+    skipped_count = 0
+    reports = []
+    if args.report_jsonl:
+        reports.append(JsonLinesReport(args.report_jsonl))
+    if args.junit_xml:
+        reports.append(JUnitReport(args.junit_xml))
+    for path in files:
         fields["path"] = path
         if config.progress:
             print("Testing file {path} ... ".format(**fields), end="")
             sys.stdout.flush()
-        subs = def_subs.copy()
-        subs["s"] = path
-        starttime = datetime.datetime.now()
-        if not check_path(path, subs, config, TestFailure.print_message):
+        result = next(results)
+        if history and not result.cached() and not result.cancelled:
+            history.record(path, result.duration, result.success)
+        for report in reports:
+            report.add(result)
+        if result.profile:
+            result.profile.start()
+        for failure in result.failures:
+            failure.print_message()
+        if result.profile:
+            result.profile.lap("format")
+            profiled.append(result)
+        if benchmark:
+            benchmarked.append(result)
+        if not result.success:
             failure_count += 1
+        elif result.cancelled:
+            skipped_count += 1
+            if config.progress:
+                print("{YELLOW}skipped{RESET}".format(**fields))
+        elif config.progress and result.cached():
+            print("{GREEN}cached{RESET}".format(**fields))
         elif config.progress:
-            endtime = datetime.datetime.now()
-            duration_ms = round((endtime - starttime).total_seconds() * 1000)
+            duration_ms = round(result.duration * 1000)
             print(
                 "{GREEN}ok{RESET} ({duration} ms)".format(
                     duration=duration_ms, **fields
                 )
             )
+    if config.cancel and config.cancel.is_set():
+        print(
+            "{RED}Stopped{RESET} after {failures} failed files, "
+            "skipped {skipped} files.".format(
+                failures=failure_count, skipped=skipped_count, **fields
+            )
+        )
+    for report in reports:
+        report.close()
+    if config.shells:
+        config.shells.close()
+    if config.cache:
+        config.cache.prune()
+    if config.incremental:
+        config.incremental.save()
+    if history:
+        history.save()
+    if benchmark:
+        report = stats_report(benchmarked)
+        print_stats(report)
+        if args.stats_json:
+            import json
+
+            write_file(args.stats_json, json.dumps(report, indent=2))
+    if config.profile:
+        report = profile_report(profiled)
+        if args.profile:
+            print_profile(report)
+        if args.profile_json:
+            import json
+
+            write_file(args.profile_json, json.dumps(report, indent=2))
     sys.exit(failure_count)
 
 
@@ -0,0 +1,174 @@
+""" A pytest plugin collecting littlecheck files as tests.
+
+Enable it with `-p littlecheck.pytest_plugin`, or with
+`pytest_plugins = ["littlecheck.pytest_plugin"]` in a conftest.py, and name
+the files to collect in the ini file:
+
+    [pytest]
+    littlecheck_files = tests/checks/*.py
+    littlecheck_substitutions = python=/usr/bin/python3
+
+Each file is a collector with one item per RUN line. The file is parsed once,
+when it is collected, and its items share the Checker. Parsed files are also
+stored in the pytest cache directory, which is pruned like littlecheck's own
+cache at the end of the session. The workers of pytest-xdist each collect
+every file at the same time, so only one of them parses a file while the others
+wait for it and then load it from the cache, as later sessions do.
+"""
+
+import fnmatch
+import os
+
+import pytest
+
+from .littlecheck import (
+    CheckerCache,
+    CheckerError,
+    Config,
+    TestRun,
+    load_checker,
+    parse_subs,
+)
+
+# The substitutions, Config and CheckerCache (or None) of the session.
+STATE_KEY = pytest.StashKey()
+
+
+def pytest_addoption(parser):
+    parser.addini(
+        "littlecheck_files",
+        "Glob patterns of the files to check with littlecheck, relative to the "
+        "rootdir",
+        type="args",
+        default=[],
+    )
+    parser.addini(
+        "littlecheck_substitutions",
+        "Substitutions for RUN lines, like bash=/bin/bash",
+        type="linelist",
+        default=[],
+    )
+    parser.addini(
+        "littlecheck_timeout",
+        "Default number of seconds a RUN command may take",
+        default=None,
+    )
+
+
+def pytest_configure(config):
+    subs = {"%": "%"}
+    subs.update(parse_subs(config.getini("littlecheck_substitutions")))
+    check_config = Config()
+    check_config.cwd = str(config.rootpath)
+    timeout = config.getini("littlecheck_timeout")
+    if timeout:
+        check_config.timeout = float(timeout)
+    cache = None
+    # The cache provider is a plugin too, and may be disabled.
+    if getattr(config, "cache", None) is not None:
+        cache = CheckerCache(str(config.cache.mkdir("littlecheck")))
+    config.stash[STATE_KEY] = (subs, check_config, cache)
+
+
+def pytest_unconfigure(config):
+    cache = config.stash.get(STATE_KEY, (None, None, None))[2]
+    # Workers of pytest-xdist leave it to the controller, which ends last.
+    if cache is not None and not hasattr(config, "workerinput"):
+        cache.prune()
+
+
+def load_exclusively(path, cache, cwd):
+    """ Return the Checker for the file at path, relative to cwd, like
+        load_checker. While one process parses a file and stores it in the
+        cache, others wanting the same contents wait for it, where fcntl is
+        available.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    if cache is None or fcntl is None:
+        return load_checker(path, cache, cwd=cwd)
+    try:
+        with open(os.path.join(cwd, path), "rb") as fd:
+            key = cache.key(fd.read())
+        lock = open(os.path.join(cache.directory, key + ".lock"), "a")
+    except (IOError, OSError):
+        return load_checker(path, cache, cwd=cwd)
+    # The lock is released when the file is closed.
+    with lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return load_checker(path, cache, cwd=cwd)
+
+
+def pytest_collect_file(file_path, parent):
+    config = parent.config
+    patterns = config.getini("littlecheck_files")
+    if not patterns:
+        return None
+    path = os.path.relpath(str(file_path), str(config.rootpath))
+    if any(fnmatch.fnmatch(path, pattern) for pattern in patterns):
+        return LittlecheckFile.from_parent(parent, path=file_path)
+    return None
+
+
+class LittlecheckFailure(Exception):
+    """ Raised by a LittlecheckItem whose output did not match.
+
+    Attributes:
+        failure: the TestFailure.
+    """
+
+    def __init__(self, failure):
+        super(LittlecheckFailure, self).__init__(failure.message())
+        self.failure = failure
+
+
+class LittlecheckFile(pytest.File):
+    """ A littlecheck file, collecting a LittlecheckItem per RUN line. """
+
+    def collect(self):
+        subs, config, cache = self.config.stash[STATE_KEY]
+        # Commands run in the rootdir, and %s is the path relative to it, like
+        # running littlecheck there.
+        path = os.path.relpath(str(self.path), config.cwd)
+        try:
+            checker = load_exclusively(path, cache, config.cwd)
+        except CheckerError as e:
+            where = "{}:{}".format(path, e.line.number) if e.line else path
+            raise self.CollectError("Error in {}: {}".format(where, e))
+        subs = subs.copy()
+        subs["s"] = path
+        for runcmd in checker.runcmds:
+            yield LittlecheckItem.from_parent(
+                self,
+                name="line{}".format(runcmd.line.number),
+                checker=checker,
+                runcmd=runcmd,
+                subs=subs,
+            )
+
+
+class LittlecheckItem(pytest.Item):
+    """ One RUN line of a littlecheck file. """
+
+    def __init__(self, *, checker, runcmd, subs, **kwargs):
+        super(LittlecheckItem, self).__init__(**kwargs)
+        self.checker = checker
+        self.runcmd = runcmd
+        self.subs = subs
+
+    def runtest(self):
+        config = self.config.stash[STATE_KEY][1]
+        checker = self.checker
+        failure = TestRun(checker.name, self.runcmd, checker, self.subs, config).run()
+        if failure:
+            raise LittlecheckFailure(failure)
+
+    def repr_failure(self, excinfo):
+        if isinstance(excinfo.value, (LittlecheckFailure, CheckerError)):
+            return str(excinfo.value)
+        return super(LittlecheckItem, self).repr_failure(excinfo)
+
+    def reportinfo(self):
+        return self.path, self.runcmd.line.number - 1, "RUN: " + self.runcmd.args
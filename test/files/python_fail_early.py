@@ -0,0 +1,15 @@
+# RUN: /usr/bin/python %s
+
+import sys
+import time
+
+print("one")
+# CHECK: one
+print("two")
+# CHECK: zwei
+for i in range(3, 10):
+    print(i)
+sys.stdout.flush()
+
+# Without --fail-early, this would take a long time.
+time.sleep(60)
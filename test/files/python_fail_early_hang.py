@@ -0,0 +1,10 @@
+# RUN: /usr/bin/python %s
+
+import sys
+import time
+
+print("wrong")
+sys.stdout.flush()
+# --fail-early has to stop us, as we never finish the output.
+time.sleep(60)
+# CHECK: right
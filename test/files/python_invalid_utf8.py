@@ -0,0 +1,9 @@
+# RUN: /usr/bin/python %s
+
+import sys
+import time
+
+sys.stdout.buffer.write(b"\xff\n")
+sys.stdout.flush()
+time.sleep(60)
+# CHECK: something
@@ -0,0 +1,11 @@
+# RUN: /usr/bin/python %s alpha 0.3
+# RUN: /usr/bin/python %s beta 0.2
+# RUN: /usr/bin/python %s gamma 0.1
+
+import sys
+import time
+
+# Sleep so that later RUN lines finish first when run concurrently.
+time.sleep(float(sys.argv[2]))
+print(sys.argv[1])
+# CHECK: alpha
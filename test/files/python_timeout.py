@@ -0,0 +1,15 @@
+# RUN: /usr/bin/python %s
+# TIMEOUT: 0.5
+
+import subprocess
+import sys
+import time
+
+print("started")
+sys.stdout.flush()
+sys.stderr.write("waiting\n")
+sys.stderr.flush()
+# The grandchild keeps our stdout open, so it must be killed too.
+subprocess.Popen(["sleep", "60"])
+time.sleep(60)
+# CHECK: started
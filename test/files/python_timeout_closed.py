@@ -0,0 +1,14 @@
+# RUN: /usr/bin/python %s
+# TIMEOUT: 0.5
+
+import os
+import sys
+import time
+
+print("started")
+sys.stdout.flush()
+# Without its output, the command can only be stopped by the timeout.
+os.close(1)
+os.close(2)
+time.sleep(60)
+# CHECK: started
@@ -13,7 +13,7 @@ class LittlecheckTest(unittest.TestCase):
         test_dir = os.path.dirname(os.path.abspath(__file__))
         os.chdir(os.path.join(test_dir, "files"))
 
-    def do_1_path_test(self, name):
+    def do_1_path_test(self, name, conf=None):
         """ Run a single test. The name is the test name.
            The input file is the name with .py extension, the expected
            output of littlecheck is the name with .expected extension.
@@ -21,7 +21,7 @@ class LittlecheckTest(unittest.TestCase):
         test_path = name + ".py"
         expected_output_path = name + ".expected"
         subs = {"%": "%", "s": test_path}
-        conf = littlecheck.Config()
+        conf = conf or littlecheck.Config()
         failures = []
         success = littlecheck.check_path(test_path, subs, conf, failures.append)
         failures_message = "\n".join([f.message() for f in failures]).strip()
@@ -57,3 +57,868 @@ class LittlecheckTest(unittest.TestCase):
 
     def test_py_color(self):
         self.do_1_path_test("python_color")
+
+    def test_py_multi_run(self):
+        self.do_1_path_test("python_multi_run")
+
+    def test_py_multi_run_concurrent(self):
+        conf = littlecheck.Config()
+        conf.run_jobs = 3
+        self.do_1_path_test("python_multi_run", conf)
+
+    def test_fail_early(self):
+        conf = littlecheck.Config()
+        conf.fail_early = True
+        self.do_1_path_test("python_fail_early", conf)
+
+    def test_fail_early_same_messages(self):
+        conf = littlecheck.Config()
+        conf.fail_early = True
+        for name in [
+            "python_ok",
+            "python_err1",
+            "python_middle_error",
+            "python_missing_output",
+            "python_extra_output",
+            "python_out_vs_err",
+        ]:
+            self.do_1_path_test(name, conf)
+
+    def test_no_after_context(self):
+        # Without context lines, a mismatch is still shown in a Context block.
+        for fail_early in (False, True):
+            conf = littlecheck.Config()
+            conf.after = 0
+            conf.fail_early = fail_early
+            failures = []
+            subs = {"%": "%", "s": "python_err1.py"}
+            littlecheck.check_path("python_err1.py", subs, conf, failures.append)
+            message = failures[0].message()
+            self.assertIn("Context:\n    ALPHA <= does not match 'BETA'", message)
+            self.assertNotIn("GAMMA1", message)
+            self.assertEqual(failures[0].to_dict()["after"], [])
+
+    def test_fail_early_hang(self):
+        import time
+
+        for after in (0, 5):
+            conf = littlecheck.Config()
+            conf.fail_early = True
+            conf.after = after
+            failures = []
+            subs = {"%": "%", "s": "python_fail_early_hang.py"}
+            start = time.monotonic()
+            success = littlecheck.check_path(
+                "python_fail_early_hang.py", subs, conf, failures.append
+            )
+            self.assertLess(time.monotonic() - start, 10)
+            self.assertFalse(success)
+            self.assertEqual(failures[0].kind(), "mismatch")
+            self.assertEqual(failures[0].line.text, "wrong\n")
+
+    def test_fail_early_error_kills_command(self):
+        from unittest import mock
+
+        procs = []
+        spawn = littlecheck.TestRun.spawn
+
+        def record_spawn(testrun, stdout, stderr):
+            procs.append(spawn(testrun, stdout, stderr))
+            return procs[-1]
+
+        conf = littlecheck.Config()
+        conf.fail_early = True
+        subs = {"%": "%", "s": "python_invalid_utf8.py"}
+        with mock.patch.object(littlecheck.TestRun, "spawn", record_spawn):
+            with self.assertRaises(UnicodeDecodeError):
+                littlecheck.check_path("python_invalid_utf8.py", subs, conf, print)
+        self.assertIsNotNone(procs[0].poll())
+        self.assertTrue(procs[0].stdout.closed)
+
+    def test_timeout(self):
+        for fail_early in (False, True):
+            conf = littlecheck.Config()
+            conf.fail_early = fail_early
+            failures = []
+            subs = {"%": "%", "s": "python_timeout.py"}
+            success = littlecheck.check_path(
+                "python_timeout.py", subs, conf, failures.append
+            )
+            self.assertFalse(success)
+            self.assertEqual(len(failures), 1)
+            failure = failures[0]
+            self.assertIsInstance(failure, littlecheck.TimeoutFailure)
+            self.assertGreaterEqual(failure.elapsed, 0.5)
+            self.assertEqual(failure.stdout, ["started\n"])
+            self.assertEqual(failure.stderr, ["waiting\n"])
+            self.assertIn("timed out after", failure.message())
+
+    def test_timeout_closed_output(self):
+        for fail_early in (False, True):
+            conf = littlecheck.Config()
+            conf.fail_early = fail_early
+            failures = []
+            subs = {"%": "%", "s": "python_timeout_closed.py"}
+            success = littlecheck.check_path(
+                "python_timeout_closed.py", subs, conf, failures.append
+            )
+            self.assertFalse(success)
+            self.assertEqual(len(failures), 1)
+            failure = failures[0]
+            self.assertIsInstance(failure, littlecheck.TimeoutFailure)
+            self.assertLess(failure.elapsed, 10)
+            self.assertEqual(failure.stdout, ["started\n"])
+
+    def test_timeout_invalid(self):
+        lines = littlecheck.Line.readfile(["# RUN: true\n", "# TIMEOUT: soon\n"], "t")
+        with self.assertRaises(littlecheck.CheckerError):
+            littlecheck.Checker("t", lines)
+
+    def test_checker_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = littlecheck.CheckerCache(cache_dir)
+            parsed = littlecheck.load_checker("python_ok.py", cache)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached = littlecheck.load_checker("python_ok.py", cache)
+            self.assertIsNot(cached, parsed)
+            self.assertEqual(cached.to_dict(), parsed.to_dict())
+            self.assertIsNotNone(parsed.digest)
+            self.assertEqual(cached.digest, parsed.digest)
+            self.assertEqual(cached.outchecks[-1].line.number, 24)
+            self.assertEqual(cached.outchecks[-1].line.file, "python_ok.py")
+
+            conf = littlecheck.Config()
+            conf.cache = cache
+            self.do_1_path_test("python_err1", conf)
+            self.do_1_path_test("python_err1", conf)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # Lock files go with their entries.
+            entry = sorted(os.listdir(cache_dir))[0]
+            for name in (entry[: -len(".json")], "gone"):
+                open(os.path.join(cache_dir, name + ".lock"), "w").close()
+            cache.prune()
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+            cache.max_size = 0
+            cache.prune()
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_incremental(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            state_path = os.path.join(tmp, "incremental.json")
+            conf = littlecheck.Config()
+            conf.incremental = littlecheck.IncrementalState(state_path)
+            subs = {"%": "%"}
+            result = littlecheck.check_one("python_ok.py", subs, conf)
+            self.assertTrue(result.success)
+            self.assertFalse(result.cached())
+            result = littlecheck.check_one("python_ok.py", subs, conf)
+            self.assertTrue(result.cached())
+
+            # Failures are never skipped.
+            for _ in range(2):
+                result = littlecheck.check_one("python_err1.py", subs, conf)
+                self.assertFalse(result.success)
+                self.assertFalse(result.cached())
+
+            conf.incremental.save()
+            conf.incremental = littlecheck.IncrementalState(state_path)
+            result = littlecheck.check_one("python_ok.py", subs, conf)
+            self.assertTrue(result.cached())
+
+    def test_command_dependencies(self):
+        deps = littlecheck.command_dependencies(
+            "python python_ok.py < python_err1.py | cat > python_color.py"
+        )
+        self.assertEqual(len(deps), 4)
+        self.assertEqual(deps[1:3], ["python_ok.py", "python_err1.py"])
+
+    def test_from_text_matches_lines(self):
+        text = (
+            "#!/bin/sh\n"
+            "  # RUN: %s one\n"
+            "echo '# RUN: not at the start'\n"
+            "#CHECK:  spaced  \n"
+            "\t#\tCHECKERR:\t{{a|b}}c\n"
+            "# CHECK: \n"
+            "\u2028# CHECK: unicode space\n"
+            "# CHECK:missing space\n"
+            "# TIMEOUT: 3\n"
+            "# CHECK: no newline at the end"
+        )
+        lines = littlecheck.Line.readfile(io.StringIO(text), "t")
+        expected = littlecheck.Checker("t", lines).to_dict()
+        self.assertEqual(littlecheck.Checker.from_text("t", text).to_dict(), expected)
+        self.assertEqual(len(expected["outchecks"]), 3)
+
+        # Without RUN lines, the shebang is used.
+        checker = littlecheck.Checker.from_text("t", "#!/bin/sh -e\n# CHECK: x\n")
+        self.assertEqual(checker.runcmds[0].args, "/bin/sh -e %s")
+
+    def test_output_buffer(self):
+        for data in [b"", b"\n", b"a", b"a\nb\n", b"a\r\n\nb\xc3\xa4", b"\n\n"]:
+            expected = [s + "\n" for s in data.decode("utf-8").split("\n")]
+            output = littlecheck.OutputBuffer(data)
+            self.assertEqual(list(output), expected)
+            self.assertEqual(len(output), len(expected))
+            self.assertEqual([output.line(i) for i in range(len(output))], expected)
+
+    def test_spill(self):
+        names = [
+            "python_ok",
+            "python_err1",
+            "python_missing_output",
+            "python_extra_output",
+            "python_out_vs_err",
+            "python_color",
+        ]
+        with tempfile.TemporaryDirectory() as spill_dir:
+            conf = littlecheck.Config()
+            conf.spill_dir = spill_dir
+            for name in names:
+                self.do_1_path_test(name, conf)
+            self.assertEqual(os.listdir(spill_dir), [])
+        conf = littlecheck.Config()
+        conf.spill_threshold = 4
+        for name in names:
+            self.do_1_path_test(name, conf)
+
+    def test_mapped_output(self):
+        for data in [b"", b"\n", b"a", b"a\nb\n", b"a\r\n\nb\xc3\xa4", b"\n\n"]:
+            with tempfile.TemporaryFile() as fd:
+                fd.write(data)
+                output = littlecheck.MappedOutput(fd)
+            expected = list(littlecheck.OutputBuffer(data))
+            self.assertEqual(list(output), expected)
+            self.assertEqual([output.line(i) for i in range(len(output))], expected)
+
+    def test_escape_string(self):
+        text = "".join(chr(c) for c in range(0x3000)) + "\U0001f600\udcff"
+        expected = "".join(littlecheck.esc(ch) for ch in text)
+        self.assertEqual(littlecheck.escape_string(text), expected)
+        self.assertEqual(littlecheck.escape_string(text), expected)
+        self.assertEqual(littlecheck.escape_string("a\tb\x1b"), "a\\tb\\x1b")
+
+    def test_shard_files(self):
+        paths = ["f%d" % i for i in range(10)]
+        shards = [littlecheck.shard_files(paths, i, 3) for i in (1, 2, 3)]
+        self.assertEqual(shards[0], ["f0", "f3", "f6", "f9"])
+        self.assertEqual(sorted(sum(shards, [])), paths)
+
+    def test_shard_files_balanced(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            history = littlecheck.TimingHistory(os.path.join(tmp, "timings.json"))
+            for path, duration in [("a", 10), ("b", 6), ("c", 5), ("d", 4)]:
+                history.record(path, duration)
+            history.save()
+            history = littlecheck.TimingHistory(os.path.join(tmp, "timings.json"))
+        self.assertEqual(history.duration("./a"), 10)
+        paths = ["a", "b", "c", "d", "new"]
+        shards = [littlecheck.shard_files(paths, i, 2, history) for i in (1, 2)]
+        # The unknown file counts as the average of 6.25 seconds.
+        self.assertEqual(shards, [["a", "c"], ["b", "d", "new"]])
+
+    def test_schedule_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            history = littlecheck.TimingHistory(os.path.join(tmp, "timings.json"))
+        for path, duration in [("short", 1), ("long", 9), ("fixed", 2)]:
+            history.record(path, duration)
+        history.record("old", 3, passed=False)
+        history.record("recent", 2, passed=False)
+        history.files["old"]["failed_at"] -= 60
+        history.record("fixed", 2, passed=True)
+        paths = ["short", "fixed", "old", "new", "long", "recent"]
+        self.assertEqual(
+            littlecheck.schedule_files(paths, history),
+            # The unknown file counts as the average of 3.4 seconds.
+            ["recent", "old", "long", "new", "fixed", "short"],
+        )
+
+    def test_profile(self):
+        config = littlecheck.Config()
+        config.profile = True
+        result = littlecheck.check_one("python_multi_run.py", {"%": "%"}, config)
+        self.assertEqual(set(result.profile.phases), {"read", "parse"})
+        report = littlecheck.profile_report([result])
+        runs = report["files"][0]["runs"]
+        self.assertEqual(len(runs), 3)
+        for run in runs:
+            self.assertEqual(
+                set(run["phases"]),
+                {"substitute", "spawn", "wait", "decode", "match"},
+            )
+            if hasattr(os, "wait4"):
+                self.assertGreater(run["usage"]["maxrss"], 0)
+        self.assertGreaterEqual(report["totals"]["wait"], 0.1 + 0.2 + 0.3)
+        result = littlecheck.check_one("python_ok.py", {}, littlecheck.Config())
+        self.assertIsNone(result.profile)
+
+    def test_report_jsonl(self):
+        import json
+
+        config = littlecheck.Config()
+        results = [
+            littlecheck.check_one(name, {"%": "%"}, config)
+            for name in ("python_ok.py", "python_err1.py")
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "report.jsonl")
+            report = littlecheck.JsonLinesReport(path)
+            report.add(results[0])
+            # Records are written as each file finishes.
+            with open(path) as fd:
+                self.assertEqual(len(fd.readlines()), 2)
+            report.add(results[1])
+            report.close()
+            with open(path) as fd:
+                records = [json.loads(line) for line in fd]
+        self.assertEqual(
+            [(r["event"], r["file"], r["status"]) for r in records],
+            [
+                ("run", "python_ok.py", "pass"),
+                ("file", "python_ok.py", "pass"),
+                ("run", "python_err1.py", "fail"),
+                ("file", "python_err1.py", "fail"),
+            ],
+        )
+        failure = records[2]["failure"]
+        self.assertEqual(failure["kind"], "mismatch")
+        self.assertEqual(failure["check_type"], "CHECKERR")
+        self.assertEqual(failure["input_lineno"], 6)
+        self.assertEqual(failure["output_file"], "stderr")
+        self.assertEqual(failure["output_lineno"], 1)
+        self.assertEqual(failure["after"], ["GAMMA%d" % i for i in range(1, 6)])
+        self.assertGreater(records[2]["duration"], 0)
+
+    def test_junit_xml(self):
+        import xml.etree.ElementTree as ET
+
+        config = littlecheck.Config()
+        config.colorize = True
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "junit.xml")
+            report = littlecheck.JUnitReport(path)
+            for name in ("python_ok.py", "python_err1.py"):
+                report.add(littlecheck.check_one(name, {"%": "%"}, config))
+            report.close()
+            root = ET.parse(path).getroot()
+        suites = root.findall("testsuite")
+        self.assertEqual([suite.get("failures") for suite in suites], ["0", "1"])
+        failure = suites[1].find("testcase/failure")
+        self.assertEqual(failure.get("type"), "mismatch")
+        self.assertIn("ALPHA <= does not match 'BETA'", failure.text)
+        self.assertNotIn("\x1b", failure.text)
+
+    def test_junit_xml_control_characters(self):
+        import xml.etree.ElementTree as ET
+
+        with tempfile.TemporaryDirectory() as tmp:
+            name = os.path.join(tmp, "control.test")
+            with open(name, "w") as fd:
+                fd.write("# RUN: printf '\\001oops\\n' # \x02\n")
+            path = os.path.join(tmp, "junit.xml")
+            report = littlecheck.JUnitReport(path)
+            report.add(littlecheck.check_one(name, {"%": "%"}, littlecheck.Config()))
+            report.close()
+            testcase = ET.parse(path).getroot().find("testsuite/testcase")
+        self.assertIn("# \\x02", testcase.get("name"))
+        failure = testcase.find("failure")
+        self.assertEqual(failure.get("type"), "extra_output")
+        self.assertIn("\\x01oops", failure.text)
+
+    def test_connect_unsupported_options(self):
+        import contextlib
+
+        parser = littlecheck.get_argparse()
+        args = parser.parse_args(["--connect", "sock", "-A", "2", "a"])
+        littlecheck.check_mode_options(
+            parser, args, "--connect", littlecheck.CONNECT_UNSUPPORTED
+        )
+        for option in (["--shard", "1/2"], ["-x"], ["-j", "2"], ["--junit-xml", "j"]):
+            args = parser.parse_args(["--connect", "sock"] + option + ["a"])
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                with self.assertRaises(SystemExit):
+                    littlecheck.check_mode_options(
+                        parser, args, "--connect", littlecheck.CONNECT_UNSUPPORTED
+                    )
+            self.assertIn("--connect can't be used with", stderr.getvalue())
+
+    def test_server(self):
+        import json
+        import socket
+        import threading
+
+        with tempfile.TemporaryDirectory() as tmp:
+            address = os.path.join(tmp, "lc.sock")
+            server = littlecheck.make_server(address)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(address)
+                with sock, sock.makefile("rwb") as stream:
+                    responses = []
+                    for path in ("python_ok.py", "python_err1.py", "missing.py"):
+                        request = {"path": path, "cwd": os.getcwd()}
+                        stream.write(json.dumps(request).encode("utf-8") + b"\n")
+                        stream.flush()
+                        responses.append(json.loads(stream.readline().decode("utf-8")))
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+        self.assertTrue(responses[0]["success"])
+        self.assertEqual(responses[0]["output"], "")
+        self.assertFalse(responses[1]["success"])
+        self.assertIn("The CHECKERR on line 6 wants", responses[1]["output"])
+        self.assertEqual(responses[1]["failures"][0]["kind"], "mismatch")
+        self.assertIn("error", responses[2])
+
+    def test_memory_checker_cache(self):
+        cache = littlecheck.MemoryCheckerCache(max_entries=1)
+        first = littlecheck.load_checker("python_ok.py", cache)
+        self.assertIs(littlecheck.load_checker("python_ok.py", cache), first)
+        littlecheck.load_checker("python_err1.py", cache)
+        self.assertIsNot(littlecheck.load_checker("python_ok.py", cache), first)
+
+    def test_direct_argv(self):
+        direct_argv = littlecheck.direct_argv
+        self.assertEqual(
+            direct_argv("/usr/bin/python  'a b' \"c\" --flag=1"),
+            ["/usr/bin/python", "a b", "c", "--flag=1"],
+        )
+        for command in (
+            "python a | cat",
+            "python a > out",
+            "python $HOME",
+            "python *.py",
+            "FOO=1 python",
+            "cd dir",
+            "echo hi",
+            "python 'unterminated",
+            "",
+        ):
+            self.assertIsNone(direct_argv(command), command)
+
+    def test_missing_command(self):
+        for command in ("/nonexistent/tool --flag", "cd / && /nonexistent/tool"):
+            checker = littlecheck.Checker.from_text("test", "# RUN: %s\n" % command)
+            testrun = littlecheck.TestRun(
+                "test", checker.runcmds[0], checker, {}, littlecheck.Config()
+            )
+            self.assertEqual(testrun.argv is None, "&&" in command)
+            with self.assertRaisesRegex(littlecheck.CheckerError, "could not be found"):
+                testrun.run()
+
+    def test_persistent_shell(self):
+        shells = littlecheck.ShellSessions()
+        try:
+            shell = shells.get()
+            self.assertIsNot(shells.get(), shell)
+            shells.release(shell)
+            self.assertIs(shells.get(), shell)
+            status, out, err = shell.run("echo out; echo err >&2; cd /; exit 3")
+            with out, err:
+                self.assertEqual(status, 3)
+                self.assertEqual((out.read(), err.read()), (b"out\n", b"err\n"))
+            status, out, err = shell.run("pwd; read x", "/")
+            with out, err:
+                self.assertEqual(status, 1)
+                self.assertEqual(out.read(), b"/\n")
+            # A syntax error only ends the subshell.
+            status, out, err = shell.run("echo 'unterminated")
+            with out, err:
+                self.assertNotEqual(status, 0)
+            status, out, err = shell.run("true")
+            with out, err:
+                self.assertEqual(status, 0)
+            shells.close()
+
+            config = littlecheck.Config()
+            config.shells = shells
+            config.run_jobs = 2
+            names = ["python_ok.py", "python_err1.py", "python_multi_run.py"] * 3
+            results = [
+                littlecheck.check_one(name, {"%": "%"}, config) for name in names
+            ]
+            # Every file runs its RUN lines in new threads, in the same shells.
+            self.assertLessEqual(len(shells.sessions), 2)
+        finally:
+            shells.close()
+        self.assertTrue(results[0].success)
+        config = littlecheck.Config()
+        expected = littlecheck.check_one("python_err1.py", {"%": "%"}, config)
+        self.assertEqual(
+            results[1].failures[0].message(), expected.failures[0].message()
+        )
+
+    def test_max_failures(self):
+        import time
+
+        config = littlecheck.Config()
+        config.cancel = littlecheck.Cancellation(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            slow = os.path.join(tmp, "slow.test")
+            with open(slow, "w") as fd:
+                fd.write("# RUN: sleep 30\n# RUN: sleep 30\n")
+            starttime = time.monotonic()
+            results = list(
+                littlecheck.run_jobs(
+                    lambda path: littlecheck.check_one(path, {"%": "%"}, config),
+                    [slow, "python_err1.py", "python_ok.py"],
+                    2,
+                )
+            )
+        # The running sleep is killed, and the rest is skipped.
+        self.assertLess(time.monotonic() - starttime, 10)
+        self.assertTrue(config.cancel.is_set())
+        self.assertTrue(results[0].cancelled)
+        self.assertEqual([run.cancelled for run in results[0].runs], [True, True])
+        self.assertEqual(results[0].failures, [])
+        self.assertFalse(results[1].success)
+        self.assertTrue(results[2].cancelled)
+        self.assertEqual(results[2].runs, [])
+
+    def test_check_literal(self):
+        cases = [
+            ("abc", "abc", None),
+            ("a  b", "a  b", None),
+            ("abc  ", None, ""),
+            ("ab{{c+}}d", None, "ab"),
+            ("{{a}}b", None, ""),
+            ("", "", None),
+        ]
+        lines = ["abc\n", "  abc \t\n", "abcc\n", "a  b\n", "abc  \n", "abccd\n"]
+        lines += ["ab\n", "\n", "", " x abc\n", "ab\u2003\n", "\u2003ab c\n"]
+        for text, literal, prefix in cases:
+            check = littlecheck.CheckCmd.parse(littlecheck.Line(text, 1, "t"), "CHECK")
+            self.assertEqual(check.literal, literal)
+            if prefix is not None:
+                self.assertEqual(check.prefix, prefix)
+            for line in lines:
+                self.assertEqual(
+                    check.matches(line),
+                    check.regex.match(line) is not None,
+                    (text, line),
+                )
+
+    def test_budgets(self):
+        def check(budget):
+            text = "# RUN: /usr/bin/python -c 'print(1)'\n# CHECK: 1\n" + budget
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "budget.test")
+                with open(path, "w") as fd:
+                    fd.write(text)
+                return littlecheck.check_one(path, {"%": "%"}, littlecheck.Config())
+
+        checker = littlecheck.Checker.from_text(
+            "t", "# RUN: true\n# MAXTIME: 2.5\n# MAXCPU: 1\n# MAXRSS: 1.5GiB\n"
+        )
+        self.assertEqual(checker.maxtime, 2.5)
+        self.assertEqual(checker.maxcpu, 1)
+        self.assertEqual(checker.maxrss, 1536 * 1024 * 1024)
+        data = checker.to_dict()
+        self.assertEqual(littlecheck.Checker.from_dict("t", data).to_dict(), data)
+        for budget in ("MAXTIME: 0", "MAXCPU: soon", "MAXRSS: 10X", "MAXRSS: 0"):
+            with self.assertRaises(littlecheck.CheckerError):
+                littlecheck.Checker.from_text("t", "# RUN: true\n# %s\n" % budget)
+
+        self.assertTrue(check("# MAXTIME: 60\n# MAXRSS: 1G\n# MAXCPU: 60\n").success)
+        result = check("# MAXTIME: 0.000001\n")
+        self.assertEqual(result.failures[0].kind(), "budget")
+        self.assertEqual(result.failures[0].budget, "MAXTIME")
+        if hasattr(os, "wait4"):
+            failure = check("# MAXRSS: 1K\n").failures[0]
+            self.assertEqual((failure.budget, failure.limit), ("MAXRSS", 1024))
+            self.assertGreater(failure.measured, 1024)
+            self.assertIn("The MAXRSS budget was exceeded", failure.message())
+            self.assertIn("(limit: 1 KiB)", failure.message())
+
+    def test_repeat(self):
+        config = littlecheck.Config()
+        config.repeat = 4
+        config.warmup = 1
+        result = littlecheck.check_one("python_ok.py", {"%": "%"}, config)
+        self.assertTrue(result.success)
+        report = littlecheck.stats_report([result])
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]["runs"], 4)
+        wall = report[0]["wall"]
+        self.assertLessEqual(wall["min"], wall["median"])
+        self.assertLessEqual(wall["median"], wall["p95"])
+        self.assertEqual(wall["p95"], wall["max"])
+        if hasattr(os, "wait4"):
+            self.assertGreater(report[0]["cpu"]["max"], 0)
+
+        # Output that is only wrong sometimes fails unless only the first
+        # run is checked.
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "flaky.test")
+            counter = os.path.join(tmp, "count")
+            command = "echo x >> {0}; wc -l < {0}".format(counter)
+            with open(path, "w") as fd:
+                fd.write("# RUN: %s\n# CHECK: 1\n" % command)
+            result = littlecheck.check_one(path, {"%": "%"}, config)
+            self.assertFalse(result.success)
+            os.unlink(counter)
+            config.check_first = True
+            result = littlecheck.check_one(path, {"%": "%"}, config)
+            self.assertTrue(result.success)
+            self.assertEqual(len(result.runs[0].samples), 4)
+
+    def test_summarize(self):
+        stats = littlecheck.summarize(list(range(100, 0, -1)))
+        self.assertEqual(stats, {"min": 1, "median": 50, "p95": 95, "max": 100})
+
+    def test_file_watcher(self):
+        import threading
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "watched")
+            other = os.path.join(tmp, "other")
+            for name in (path, other):
+                with open(name, "w") as fd:
+                    fd.write("a")
+            for inotify in (True, False):
+                watcher = littlecheck.FileWatcher(interval=0.05)
+                if not inotify:
+                    watcher.inotify = None
+                watcher.watch([path, other])
+
+                def change():
+                    with open(path, "w") as fd:
+                        fd.write("changed")
+
+                timer = threading.Timer(0.1, change)
+                timer.start()
+                self.assertEqual(watcher.wait(), set([path]))
+                timer.join()
+
+    def test_watch(self):
+        import io
+        from contextlib import redirect_stdout
+
+        class Watcher(object):
+            """ Reports that python_ok.py changed once, then stops. """
+
+            def __init__(self):
+                self.watched = []
+
+            def watch(self, paths):
+                self.watched.append(paths)
+
+            def wait(self):
+                if len(self.watched) > 1:
+                    raise KeyboardInterrupt
+                return set([os.path.abspath("python_ok.py")])
+
+        watcher = Watcher()
+        out = io.StringIO()
+        config = littlecheck.Config()
+        config.progress = True
+        with redirect_stdout(out):
+            littlecheck.watch(
+                ["python_ok.py", "python_err1.py"], {"%": "%"}, config, 1, watcher
+            )
+        self.assertIn(os.path.abspath("python_ok.py"), watcher.watched[0])
+        self.assertIn("/usr/bin/python", watcher.watched[0])
+        lines = out.getvalue().splitlines()
+        self.assertIn("Checked 2 files, 1 failed. Waiting for changes...", lines)
+        # Only the changed file is checked again.
+        self.assertEqual(
+            lines[-3:-1],
+            ["ok python_ok.py", "Checked 1 files, 0 failed. Waiting for changes..."],
+        )
+
+    def test_watch_max_failures(self):
+        import io
+        from contextlib import redirect_stdout
+
+        class Watcher(object):
+            """ Reports that python_ok.py changed once, then stops. """
+
+            def __init__(self):
+                self.rounds = 0
+
+            def watch(self, paths):
+                self.rounds += 1
+
+            def wait(self):
+                if self.rounds > 1:
+                    raise KeyboardInterrupt
+                return set([os.path.abspath("python_ok.py")])
+
+        out = io.StringIO()
+        config = littlecheck.Config()
+        config.progress = True
+        config.cancel = littlecheck.Cancellation(1)
+        with redirect_stdout(out):
+            littlecheck.watch(
+                ["python_err1.py", "python_ok.py"], {"%": "%"}, config, 1, Watcher()
+            )
+        lines = out.getvalue().splitlines()
+        self.assertIn("skipped python_ok.py", lines)
+        self.assertIn(
+            "Checked 1 files, 1 failed, 1 skipped. Waiting for changes...", lines
+        )
+        # The next pass starts over, and checks the skipped file.
+        self.assertEqual(
+            lines[-3:-1],
+            ["ok python_ok.py", "Checked 1 files, 0 failed. Waiting for changes..."],
+        )
+
+    def test_watch_unsupported_options(self):
+        import contextlib
+
+        parser = littlecheck.get_argparse()
+        for option in (["--junit-xml", "j"], ["--incremental"], ["--timings", "t"]):
+            args = parser.parse_args(["--watch"] + option + ["a"])
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                with self.assertRaises(SystemExit):
+                    littlecheck.check_mode_options(
+                        parser, args, "--watch", littlecheck.WATCH_UNSUPPORTED
+                    )
+            self.assertIn("--watch can't be used with", stderr.getvalue())
+
+    def test_check_one(self):
+        subs = {"%": "%"}
+        result = littlecheck.check_one("python_err1.py", subs, littlecheck.Config())
+        self.assertFalse(result.success)
+        self.assertEqual(len(result.failures), 1)
+        self.assertEqual(result.failures[0].testrun.subs["s"], "python_err1.py")
+        self.assertNotIn("s", subs)
+
+    def test_run_jobs_order(self):
+        import time
+
+        def slow_identity(n):
+            time.sleep(0.01 * (5 - n))
+            return n
+
+        results = littlecheck.run_jobs(slow_identity, range(5), 5)
+        self.assertEqual(list(results), [0, 1, 2, 3, 4])
+
+    def test_startup_imports(self):
+        import subprocess
+        import sys
+
+        # littlecheck is started once per test file, so a passing file should
+        # not load what only failures or other options need. Budget the time
+        # spent importing modules a bare interpreter doesn't, relative to the
+        # bare interpreter's own imports, like bench/startup.py --max-ms.
+        # Each module counts with its fastest of a few runs, to ignore noise.
+        budget = 5
+        script = os.path.abspath(littlecheck.littlecheck.__file__)
+        bare, started = {}, {}
+        for _ in range(5):
+            for imports, args in (
+                (bare, ["-c", "pass"]),
+                (started, [script, "python_ok.py"]),
+            ):
+                proc = subprocess.run(
+                    [sys.executable, "-X", "importtime"] + args,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                )
+                self.assertEqual(proc.returncode, 0)
+                for line in proc.stderr.splitlines():
+                    if not line.startswith("import time:"):
+                        continue
+                    self_us, _, name = line[len("import time:") :].split("|")
+                    # Skip the header.
+                    if self_us.strip().isdigit():
+                        name = name.strip()
+                        imports[name] = min(imports.get(name, 1e9), int(self_us))
+        self.assertIn("subprocess", started)
+        bare_us = sum(bare.values())
+        own_us = sum(us for name, us in started.items() if name not in bare)
+        self.assertLessEqual(
+            own_us,
+            budget * bare_us,
+            "imports took {:.1f}ms, over {} times the {:.1f}ms of a bare "
+            "interpreter".format(own_us / 1000, budget, bare_us / 1000),
+        )
+
+    def test_pytest_plugin(self):
+        import importlib.util
+        import subprocess
+        import sys
+
+        if importlib.util.find_spec("pytest") is None:
+            self.skipTest("pytest is not installed")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        with tempfile.TemporaryDirectory() as tmp:
+            ini = os.path.join(tmp, "pytest.ini")
+            with open(ini, "w") as fd:
+                fd.write(
+                    "[pytest]\n"
+                    "littlecheck_files = python_ok.py python_err1.py\n"
+                    "cache_dir = {}\n".format(os.path.join(tmp, "cache"))
+                )
+            argv = [sys.executable, "-m", "pytest", "-p", "littlecheck.pytest_plugin"]
+            argv += ["-c", ini, "--rootdir", ".", "python_ok.py", "python_err1.py"]
+            for session in range(2):
+                # The second session loads the files from the cache, and
+                # prunes it at the end.
+                if session:
+                    directory = [
+                        directory
+                        for directory, _, _ in os.walk(os.path.join(tmp, "cache"))
+                        if os.path.basename(directory) == "littlecheck"
+                    ][0]
+                    orphan = os.path.join(directory, "gone.lock")
+                    open(orphan, "w").close()
+                proc = subprocess.run(
+                    argv,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True,
+                    env=env,
+                )
+                self.assertEqual(proc.returncode, 1, proc.stdout)
+                self.assertIn("1 failed, 1 passed", proc.stdout)
+                self.assertIn("python_err1.py::line1", proc.stdout)
+                with io.open("python_err1.expected", encoding="utf-8") as fd:
+                    self.assertIn(fd.read().strip(), proc.stdout)
+            self.assertFalse(os.path.exists(orphan))
+            entries = [name for name in os.listdir(directory) if name.endswith(".json")]
+            self.assertEqual(len(entries), 2)
+
+    def test_pytest_plugin_parses_once(self):
+        import importlib.util
+        import threading
+        import time
+        from unittest import mock
+
+        if importlib.util.find_spec("pytest") is None:
+            self.skipTest("pytest is not installed")
+        from littlecheck import pytest_plugin
+
+        parsed = []
+        from_text = littlecheck.Checker.from_text
+
+        def slow_from_text(name, text):
+            parsed.append(name)
+            # Long enough for the other loader to arrive while we parse.
+            time.sleep(0.2)
+            return from_text(name, text)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = littlecheck.CheckerCache(tmp)
+            checkers = []
+
+            def load():
+                checkers.append(
+                    pytest_plugin.load_exclusively("python_ok.py", cache, ".")
+                )
+
+            with mock.patch.object(littlecheck.Checker, "from_text", slow_from_text):
+                threads = [threading.Thread(target=load) for _ in range(2)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        self.assertEqual(parsed, ["python_ok.py"])
+        self.assertEqual(checkers[0].to_dict(), checkers[1].to_dict())